@@ -27,9 +27,171 @@ import os
 DATA_PREFIX = '.iris' + os.sep
 """Data path prefix"""
 
+CONFIG_FILE_NAME = 'config.sitelle.orb'
+"""Name of the ORB configuration file of SITELLE"""
+
+CONFIG_KEYS = ('FIELD_OF_VIEW_1', 'INIT_FWHM', 'PIX_SIZE_CAM1',
+               'INIT_ANGLE', 'INIT_DX', 'INIT_DY')
+"""List of the configuration parameters used by IRIS"""
+
 KEY_LIST = ('odometer_nb', 'star_nb','fwhm-arc-1', 'fwhm-arc-1_err',
             'fwhm-arc-2', 'fwhm-arc-2_err', 'extinction', 'extinction_err',
             'background', 'background_err', 'dx-pix-1', 'dx-pix-1_err',
             'dy-pix-1', 'dy-pix-1_err', 'dx-pix-2', 'dx-pix-2_err',
             'dy-pix-2', 'dy-pix-2_err')
 """List of the parameters printed on stdout"""
+
+DEADLINE_KEY_LIST = KEY_LIST + ('fitted_star_nb',)
+"""List of the parameters printed on stdout in deadline mode"""
+
+STREAM_VERSION = 1
+"""Version of the format of the partial records printed on stdout in
+stream mode"""
+
+STREAM_KEY_LISTS = {
+    'quality': ('odometer_nb', 'quality_flag', 'peak-snr', 'sky'),
+    'cam1': ('odometer_nb', 'fwhm-arc-1', 'fwhm-arc-1_err',
+             'dx-pix-1', 'dx-pix-1_err', 'dy-pix-1', 'dy-pix-1_err'),
+    'cam2': ('odometer_nb', 'fwhm-arc-2', 'fwhm-arc-2_err',
+             'dx-pix-2', 'dx-pix-2_err', 'dy-pix-2', 'dy-pix-2_err'),
+    'merged': ('odometer_nb', 'extinction', 'extinction_err',
+               'background', 'background_err')}
+"""List of the parameters printed on stdout in stream mode as soon
+as each stage ('quality', 'cam1', 'cam2' and 'merged') is finished.
+The 'quality' record tells if the frame is analyzed ('quality_flag'
+is 0) or skipped because of its quality (see
+:py:const:`iris.constants.QUALITY_LOW_SNR` and
+:py:const:`iris.constants.QUALITY_SNR_DROP`)"""
+
+DEADLINE_STAR_CHUNK = 10
+"""Number of stars fitted at once in deadline mode"""
+
+REF_STAR_NB = None
+"""Default maximum number of reference stars fitted on each frame
+(None: all the detected stars are fitted)"""
+
+REF_STAR_ISOLATION = 5.
+"""Minimum distance (in FWHM) to the nearest star for a star to be
+considered isolated"""
+
+REF_STAR_EDGE = 10.
+"""Minimum distance (in FWHM) to the chip edge for a star to be
+considered far from the edge"""
+
+REF_CACHE_RADIUS = 30.
+"""Maximum distance (in arcseconds) between two pointings for a cached
+reference solution to be reused"""
+
+REF_CACHE_CHECK_STAR_NB = 10
+"""Number of reference stars fitted to validate a cached reference
+solution"""
+
+REF_CACHE_MIN_FIT_RATIO = 0.5
+"""Minimum ratio of stars successfully fitted in both cameras for a
+cached reference solution to be valid"""
+
+REF_CACHE_MAX_SHIFT = 3.
+"""Maximum median shift (in pixels) of the stars of a cached reference
+solution for the solution to be valid"""
+
+QUALITY_STAR_NB = 10
+"""Number of reference stars used to check the quality of a frame
+before fitting the stars"""
+
+QUALITY_MIN_SNR = 5.
+"""Minimum median peak SNR of the checked stars. Frames with a lower
+SNR are flagged with :py:const:`iris.constants.QUALITY_LOW_SNR` and
+not fitted"""
+
+QUALITY_MIN_SNR_RATIO = 0.1
+"""Minimum ratio between the median peak SNR of the checked stars and
+the one of the reference frame. Frames with a lower ratio are flagged
+with :py:const:`iris.constants.QUALITY_SNR_DROP` and not fitted"""
+
+QUALITY_LOW_SNR = 1
+"""Quality flag of a frame whose stars are too faint (e.g. closed
+shutter, dome in the way)"""
+
+QUALITY_SNR_DROP = 2
+"""Quality flag of a frame whose stars are much fainter than in the
+reference frame (e.g. clouds)"""
+
+REF_PARTITION_SIZE = 100
+"""Number of consecutive odometers whose fitted stars parameters are
+recorded in the same partition of the reference file"""
+
+DATA_DTYPE = 'float64'
+"""Data type of the frames analyzed by IRIS and stored in the output
+cubes. 'float32' halves the memory and disk space but its effect on
+the computed stats has not been measured yet on benchmark frames: it
+is opt-in"""
+
+STATS_KEYS = ('odometer_nb', 'star_nb', 'fitted_star_nb',
+              'fwhm-pix-1', 'fwhm-pix-1_err', 'fwhm-arc-1', 'fwhm-arc-1_err',
+              'fwhm-pix-2', 'fwhm-pix-2_err', 'fwhm-arc-2', 'fwhm-arc-2_err',
+              'flux', 'flux_err', 'extinction', 'extinction_err',
+              'background', 'background_err', 'dx-pix-1', 'dx-pix-1_err',
+              'dy-pix-1', 'dy-pix-1_err', 'dx-pix-2', 'dx-pix-2_err',
+              'dy-pix-2', 'dy-pix-2_err', 'quality_flag', 'peak-snr', 'sky')
+"""List of the parameters recorded in the stats file (one column per
+parameter)"""
+
+STATS_READ_ATTEMPTS = 5
+"""Number of attempts to open the stats file for reading, e.g. while
+it is opened by **iris**"""
+
+STATS_READ_DELAY = 0.05
+"""Delay (in s) between two attempts to open the stats file for
+reading"""
+
+STATS_INT_KEYS = ('odometer_nb', 'star_nb', 'fitted_star_nb',
+                  'quality_flag')
+"""Parameters of the stats file which are integers"""
+
+PREVIEW_BINNINGS = (4, 16)
+"""Binnings of the preview cubes written along with the full
+resolution cubes"""
+
+PREVIEW_DELAY = 300
+"""Delay (in ms) after which a full resolution frame is loaded by the
+viewer when the frame index stops changing"""
+
+SHARED_SLOT_NB = 2
+"""Number of exposures kept in the shared memory buffer of the last
+frames"""
+
+MAPME_TILE_MARGIN = 64
+"""Default margin (in pixels) added around each tile by
+**iris-image-mapme**. The tiled map is equal to the untiled map only
+if the margin is larger than half the size of the window used by
+orb.cutils.map_me to fit the fringes. This value is not derived from
+this window: it must be checked with the '--check' option of
+**iris-image-mapme**, which fails if the maps differ"""
+
+SCHEDULER_LIVE_CPUS = 1
+"""Number of cores reserved by each running live **iris** process.
+Batch processes share the other cores"""
+
+SCHEDULER_LIVE_TTL = 900.
+"""Time in s during which the cores of a live **iris** process stay
+reserved after the analysis of a frame. It must be longer than the
+time between two exposures so that the cores are reserved for the
+whole night"""
+
+SCHEDULER_BATCH_NICE = 10
+"""Niceness increment of the batch processes (and their workers) so
+that live processes keep the priority on a loaded host"""
+
+COMPACT_COMPRESSION = 'lzf'
+"""Compression filter used by **iris-compact** to rewrite the cubes"""
+
+COMPACT_CHUNK_SIZE = 2**20
+"""Approximate size (in bytes) of the chunks of the datasets rewritten
+by **iris-compact**"""
+
+MASTER_CACHE_DIR = DATA_PREFIX + 'masters'
+"""Directory where the master bias, dark and flat frames are cached"""
+
+DETREND_CHUNK = 256
+"""Number of rows processed at once when master frames are combined
+and applied"""
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: detrend.py
+
+## Copyright (c) 2010-2015 Thomas Martin <thomas.martin.1@ulaval.ca>
+##
+## This file is part of IRIS
+##
+## IRIS is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## IRIS is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+## or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+## License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
+
+from orb.core import Tools
+from scheduler import scheduled_imap
+import constants
+
+import os
+import time
+import hashlib
+import tempfile
+import multiprocessing
+import numpy as np
+
+
+def median_rows(job):
+    """Compute the median of a block of rows of a stack of frames and
+    write it in the master frame.
+
+    This function is called by the workers of
+    :py:meth:`MasterFrames._combine`.
+
+    :param job: Tuple (stack path, master path, xmin, xmax).
+    """
+    stack_path, master_path, xmin, xmax = job
+    stack = np.load(stack_path, mmap_mode='r')
+    master = np.load(master_path, mmap_mode='r+')
+    master[xmin:xmax,:] = np.nanmedian(stack[:,xmin:xmax,:], axis=0)
+    master.flush()
+
+
+class MasterFrames(Tools):
+    """Build, cache and apply the master bias, dark and flat frames of
+    both cameras.
+
+    Master frames are built once from lists of frames by a median
+    combination computed in parallel on blocks of rows. They are
+    stored as .npy files in a cache directory and memory-mapped when
+    needed. The cache key depends on the paths, sizes and
+    modification times of the combined frames so that a master frame
+    is built again only if its frames have changed.
+
+    * bias: median of the bias frames.
+
+    * dark: median of the bias subtracted dark frames divided by
+      their exposure time (i.e. dark current per second).
+
+    * flat: median of the bias and dark subtracted flat frames, each
+      frame being first normalized to a median of 1 so that flats
+      taken at different illumination levels can be combined. The
+      master flat is normalized to a median of 1.
+    """
+
+    def __init__(self, bias_paths=None, dark_paths=None, flat_paths=None,
+                 cache_dir=constants.MASTER_CACHE_DIR, ncpus=1,
+                 scheduler=None, **kwargs):
+        """Init class.
+
+        :param bias_paths: (Optional) List of bias frames (default
+          None).
+
+        :param dark_paths: (Optional) List of dark frames (default
+          None).
+
+        :param flat_paths: (Optional) List of flat frames (default
+          None).
+
+        :param cache_dir: (Optional) Directory where the master
+          frames are stored (default
+          :py:const:`iris.constants.MASTER_CACHE_DIR`).
+
+        :param ncpus: (Optional) Number of processes used to combine
+          the frames (default 1).
+
+        :param scheduler: (Optional) Registered
+          :py:class:`iris.scheduler.ResourceScheduler` instance giving
+          the number of processes combining the frames at the same
+          time (default None).
+
+        :param kwargs: Keyword arguments of orb.core.Tools class (see
+          ORB documentation).
+        """
+        Tools.__init__(self, **kwargs)
+        self.paths = {'bias': bias_paths, 'dark': dark_paths,
+                      'flat': flat_paths}
+        self.cache_dir = cache_dir
+        self.ncpus = max(int(ncpus), 1)
+        self.scheduler = scheduler
+        self._masters = dict()
+
+    def _get_key(self, kind):
+        """Return the cache key of a master frame.
+
+        :param kind: 'bias', 'dark' or 'flat'.
+        """
+        md5 = hashlib.md5()
+        md5.update(kind)
+        for path in self.paths[kind]:
+            st = os.stat(path)
+            md5.update('{} {} {}'.format(
+                os.path.abspath(path), st.st_size, st.st_mtime))
+        if kind != 'bias' and self.paths['bias'] is not None:
+            # dark and flat depend on the master bias
+            md5.update(self._get_key('bias'))
+        if kind == 'flat' and self.paths['dark'] is not None:
+            # flat depends on the master dark
+            md5.update(self._get_key('dark'))
+        return md5.hexdigest()
+
+    def _get_master_path(self, kind, camera):
+        """Return the path to a master frame in the cache.
+
+        :param kind: 'bias', 'dark' or 'flat'.
+        :param camera: Camera number (1 or 2).
+        """
+        return os.path.join(self.cache_dir, '{}.{}.cam{}.npy'.format(
+            kind, self._get_key(kind), camera))
+
+    def _get_temp_path(self, master_path):
+        """Create an empty temporary file with a unique name in the
+        cache directory and return its path.
+
+        :param master_path: Path to the master frame.
+        """
+        fd, path = tempfile.mkstemp(
+            suffix='.npy', prefix=os.path.basename(master_path) + '.',
+            dir=os.path.dirname(master_path))
+        os.close(fd)
+        return path
+
+    def _combine(self, kind, camera, master_path):
+        """Combine the frames of a given kind and write the master
+        frame.
+
+        The preprocessed frames are first written in a memory-mapped
+        stack, then the median of each block of rows is computed by a
+        pool of processes. The stack and the master frame are written
+        in temporary files with unique names so that concurrent builds
+        of the same master frame do not overwrite each other.
+
+        :param kind: 'bias', 'dark' or 'flat'.
+        :param camera: Camera number (1 or 2).
+        :param master_path: Path to the master frame.
+        """
+        start_time = time.time()
+        paths = self.paths[kind]
+        if kind != 'bias':
+            bias = self.get_master('bias', camera)
+        else:
+            bias = None
+        if kind == 'flat':
+            dark = self.get_master('dark', camera)
+        else:
+            dark = None
+
+        stack_path = self._get_temp_path(master_path)
+        tmp_path = self._get_temp_path(master_path)
+        try:
+            stack = None
+            for i in range(len(paths)):
+                frame, hdr = self.read_fits(paths[i], image_mode='sitelle',
+                                            chip_index=camera,
+                                            return_header=True)
+                if stack is None:
+                    stack = np.lib.format.open_memmap(
+                        stack_path, mode='w+', dtype=np.float32,
+                        shape=(len(paths), frame.shape[0], frame.shape[1]))
+                frame = np.array(frame, dtype=np.float32)
+                if bias is not None:
+                    frame -= bias
+                if kind == 'dark':
+                    frame /= float(hdr['EXPTIME'])
+                if kind == 'flat':
+                    if dark is not None:
+                        frame -= dark * float(hdr['EXPTIME'])
+                    # each flat is normalized before the combination
+                    median = np.nanmedian(frame)
+                    if median > 0:
+                        frame /= median
+                    else:
+                        self._print_warning('Flat frame {} ignored (median: {})'.format(paths[i], median))
+                        frame.fill(np.nan)
+                stack[i] = frame
+            stack.flush()
+            dimx, dimy = stack.shape[1:]
+            del stack
+
+            master = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32, shape=(dimx, dimy))
+            del master
+
+            bounds = range(0, dimx, constants.DETREND_CHUNK) + [dimx]
+            jobs = [(stack_path, tmp_path, bounds[i], bounds[i + 1])
+                    for i in range(len(bounds) - 1)]
+            if self.ncpus > 1:
+                pool = multiprocessing.Pool(self.ncpus)
+            else:
+                pool = None
+            for _ in scheduled_imap(pool, median_rows, jobs,
+                                    scheduler=self.scheduler):
+                pass
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            if kind == 'flat':
+                master = np.load(tmp_path, mmap_mode='r+')
+                master /= np.nanmedian(master)
+                master.flush()
+                del master
+
+            # renamed at the end so that an incomplete master is never
+            # found in the cache
+            os.rename(tmp_path, master_path)
+        finally:
+            for path in (stack_path, tmp_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._print_msg('Master {} of camera {} built from {} frames in {:.2f} s'.format(kind, camera, len(paths), time.time() - start_time))
+
+    def get_master(self, kind, camera):
+        """Return a master frame as a read-only memory-mapped array or
+        None if no frame of this kind has been given.
+
+        The master frame is built if it is not in the cache.
+
+        :param kind: 'bias', 'dark' or 'flat'.
+        :param camera: Camera number (1 or 2).
+        """
+        if self.paths[kind] is None or len(self.paths[kind]) == 0:
+            return None
+        if (kind, camera) not in self._masters:
+            master_path = self._get_master_path(kind, camera)
+            if not os.path.exists(master_path):
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                self._combine(kind, camera, master_path)
+            self._masters[(kind, camera)] = np.load(master_path,
+                                                    mmap_mode='r')
+        return self._masters[(kind, camera)]
+
+    def detrend(self, frame, camera, exptime=None):
+        """Remove bias and dark and divide by the flat, block of rows
+        by block of rows. Return the detrended frame as a float32
+        array. Pixels where the master flat is not positive are set
+        to NaN.
+
+        The frame is returned unchanged if no master frame has been
+        given.
+
+        :param frame: Frame to detrend.
+
+        :param camera: Camera number (1 or 2).
+
+        :param exptime: (Optional) Exposure time of the frame. Must be
+          given if dark frames are used (default None).
+        """
+        bias = self.get_master('bias', camera)
+        dark = self.get_master('dark', camera)
+        flat = self.get_master('flat', camera)
+        if dark is not None and exptime is None:
+            self._print_error('The exposure time must be given to remove the dark')
+        if bias is None and dark is None and flat is None:
+            return frame
+
+        frame = np.array(frame, dtype=np.float32)
+        for xmin in range(0, frame.shape[0], constants.DETREND_CHUNK):
+            xmax = min(xmin + constants.DETREND_CHUNK, frame.shape[0])
+            chunk = frame[xmin:xmax,:]
+            if bias is not None:
+                chunk -= bias[xmin:xmax,:]
+            if dark is not None:
+                chunk -= dark[xmin:xmax,:] * float(exptime)
+            if flat is not None:
+                flat_chunk = flat[xmin:xmax,:]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    chunk /= flat_chunk
+                # NaN and non-positive pixels of the flat
+                chunk[~(flat_chunk > 0)] = np.nan
+        return frame
@@ -21,11 +21,14 @@
 ## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
 
 from orb.core import Tools, OutHDFCube, HDFCube
-from stats import ImageStats
+from stats import ImageStats, StatsFile
+import constants
+import utils
+from shared import SharedFrames
 import numpy as np
 import os
 
-class Iris(Tools):
+class Iris(utils.ConfigCache, Tools):
     """Interface class between the user and
     :py:class:`iris.stats.ImageStats`
 
@@ -33,12 +36,19 @@ class Iris(Tools):
     """
 
     imstats = None # ImageStats instance
+    statsfile = None # StatsFile instance
+    frame_index = None # index of the frame in the output cubes
+    frame_nb = None # number of frames in the output cubes
+    daemon_port = None # listening port of the viewer daemon
     
     def __init__(self, image_path, force_refresh=False,
-                 daemon_port=None, **kwargs):
+                 daemon_port=None, ref_star_nb=constants.REF_STAR_NB,
+                 frames=None, use_cache=True, dtype=constants.DATA_DTYPE,
+                 **kwargs):
         """Init class.
 
-        :param image_path: Path to the SITELLE image.
+        :param image_path: Path to the SITELLE image. Can be None if
+          frames is given.
 
         :param force_refresh: (Optional) If True the given image is
           considered to be a reference image ad all previous files are
@@ -47,15 +57,38 @@ class Iris(Tools):
         :param kwargs: Keyword arguments of orb.core.Tools class (see
           ORB documentation).
 
-        :param daemon_port: Listening port of the viewer daemon.
+        :param daemon_port: Listening port of the viewer daemon. If
+          given, the frames can be published in shared memory for the
+          viewer (see :py:meth:`iris.iris.Iris.share_frames`).
+
+        :param ref_star_nb: (Optional) Maximum number of reference
+          stars kept when a reference image is analyzed. If None, all
+          the detected stars are kept (default
+          :py:const:`iris.constants.REF_STAR_NB`).
+
+        :param frames: (Optional) Tuple (cam1, cam2, header) of
+          already loaded data. If given, image_path is not read (see
+          :py:meth:`iris.iris.Iris.from_arrays`, default None).
+
+        :param use_cache: (Optional) If True, a reference image
+          reuses the alignment parameters computed for the same
+          pointing if they are still valid (see
+          :py:class:`iris.stats.SolutionCache`, default True).
+
+        :param dtype: (Optional) Data type of the frames and of the
+          output cubes (default :py:const:`iris.constants.DATA_DTYPE`).
         """
 
-        kwargs['config_file_name'] = 'config.sitelle.orb'
+        kwargs['config_file_name'] = constants.CONFIG_FILE_NAME
 
         Tools.__init__(self, **kwargs)
 
+        self.daemon_port = daemon_port
+
 
         self.imstats = ImageStats(image_path, force_refresh=force_refresh,
+                                  ref_star_nb=ref_star_nb, frames=frames,
+                                  use_cache=use_cache, dtype=dtype,
                                   **kwargs)
         
 
@@ -82,6 +115,11 @@ class Iris(Tools):
             del out1
 
         
+        self.frame_index = frame_index
+        self.frame_nb = new_dimz
+        self.statsfile = StatsFile(self._get_stats_file_path(),
+                                   refresh=self.imstats.refresh)
+        
         out1 = OutHDFCube(self._get_outcube_path(1),
                           (self.imstats.dimx, self.imstats.dimy, new_dimz),
                           reset=reset, overwrite=overwrite)
@@ -103,9 +141,28 @@ class Iris(Tools):
         outM.write_frame(frame_index, data=self.imstats.imM)
         outM.write_frame_attribute(
             frame_index, 'odometer_nb', self.imstats.odometer_nb)
-       
 
 
+
+    @classmethod
+    def from_arrays(cls, cam1, cam2, hdr, **kwargs):
+        """Init class from already loaded data, e.g. directly from the
+        acquisition software, instead of a FITS file.
+
+        :param cam1: Image of the camera 1.
+
+        :param cam2: Image of the camera 2.
+
+        :param hdr: Image header. Can be a simple dict but must
+          contain the keyword EXPNUM.
+
+        :param kwargs: Keyword arguments of
+          :py:meth:`iris.iris.Iris.__init__`.
+
+        .. seealso:: :py:meth:`iris.stats.ImageStats.from_arrays`
+        """
+        return cls(None, frames=(cam1, cam2, hdr), **kwargs)
+
     def _get_outcube_path(self, camera, absolute=False):
         """Return the path to the ouput cube.
 
@@ -124,8 +181,90 @@ class Iris(Tools):
             return path
 
 
-    def run_stats(self):
-        """Run statistics computation."""
-        self.imstats.compute_stats()
-        return self.imstats.get_stats()
+    def share_frames(self):
+        """Publish the frames in shared memory for the viewer listening
+        on the daemon port (see :py:class:`iris.shared.SharedFrames`).
+
+        The frames are not needed to compute the stats and should be
+        published once the stats are computed so that the copy of the
+        frames does not delay them. If no viewer is listening, the
+        frames are not published and the buffer is removed so that it
+        does not stay in memory.
+        """
+        if self.daemon_port is None: return
+        name = SharedFrames.get_name(self.daemon_port)
+        if not utils.is_daemon_listening(self.daemon_port):
+            SharedFrames.remove(name)
+            return
+        try:
+            frames = SharedFrames.create(
+                name, self.imstats.shape, self.imstats.im1.dtype)
+            frames.publish(self.imstats.odometer_nb, self.imstats.im1,
+                           self.imstats.im2, self.imstats.imM)
+            frames.close()
+        except Exception, e:
+            self._print_warning(
+                'Frames could not be shared with the viewer: {}'.format(e))
+
+    def write_previews(self):
+        """Write the binned previews of the frames (see
+        :py:const:`iris.constants.PREVIEW_BINNINGS`) in the preview
+        cubes displayed by the viewer while scrolling through the
+        frames.
+
+        The previews are not needed to compute the stats and should
+        be written once the stats are computed so that they do not
+        delay them. A preview which cannot be written is skipped with
+        a warning.
+        """
+        if self.imstats.refresh:
+            reset, overwrite = True, False
+        else:
+            reset, overwrite = False, True
+            
+        for binning in constants.PREVIEW_BINNINGS:
+            for camera, im in ((1, self.imstats.im1), (2, self.imstats.im2),
+                               (0, self.imstats.imM)):
+                path = utils.get_preview_path(
+                    self._get_outcube_path(camera), binning)
+                try:
+                    preview = utils.bin_image(im, binning)
+                    outP = OutHDFCube(
+                        path, (preview.shape[0], preview.shape[1],
+                               self.frame_nb),
+                        reset=reset, overwrite=overwrite)
+                    outP.write_frame(self.frame_index, data=preview)
+                    outP.write_frame_attribute(
+                        self.frame_index, 'odometer_nb',
+                        self.imstats.odometer_nb)
+                    del outP
+                except Exception, e:
+                    self._print_warning('Preview {} not written: {}'.format(
+                        path, e))
+
+    def _get_stats_file_path(self):
+        """Return the path to the stats file."""
+        return self._data_prefix + 'iris.stats'
+
+    def run_stats(self, deadline=None, callback=None):
+        """Run statistics computation.
+
+        :param deadline: (Optional) Time (as returned by
+          :py:meth:`time.time`) at which the fit of the stars must be
+          stopped (see :py:meth:`iris.stats.ImageStats.compute_stats`,
+          default None).
+
+        :param callback: (Optional) Function called with the partial
+          stats of each stage as soon as it is finished (see
+          :py:meth:`iris.stats.ImageStats.compute_stats`, default
+          None).
+        """
+        self.imstats.compute_stats(deadline=deadline, callback=callback)
+        stats = self.imstats.get_stats()
+        # the stats are returned even if they cannot be recorded
+        try:
+            self.statsfile.write(self.frame_index, stats)
+        except Exception, e:
+            self._print_warning('Stats not recorded in the stats file: {}'.format(e))
+        return stats
         
@@ -0,0 +1,353 @@
+#!/usr/bin/python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: live.py
+
+## Copyright (c) 2010-2015 Thomas Martin <thomas.martin.1@ulaval.ca>
+## 
+## This file is part of IRIS
+##
+## IRIS is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## IRIS is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+## or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+## License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Data displayed by iris-viewer. This module must not import GTK so
+# that the reload of the viewer can be run without display
+# (see iris-viewer-loadtest).
+import os
+import threading
+import numpy as np
+from orb.core import HDFCube
+from stats import StatsFile
+from shared import SharedFrames
+import constants
+import utils
+
+
+class StatsStore(object):
+    """Growable structured array holding the stats of all the frames
+    (one float column per key of
+    :py:const:`iris.constants.STATS_KEYS`).
+
+    A column is returned as a view, without copy, e.g.::
+
+      store['fwhm-arc-1']
+    """
+    
+    dtype = np.dtype([(key, float) for key in constants.STATS_KEYS])
+    frame_nb = 0 # number of frames in the store
+
+    def __init__(self, capacity=256):
+        """Init class.
+
+        :param capacity: (Optional) Initial number of frames which can
+          be stored before the buffer is grown (default 256).
+        """
+        self._data = np.empty(capacity, dtype=self.dtype)
+        self.clear()
+
+    def __getitem__(self, key):
+        """Return a view of the column of a given key."""
+        return self._data[key][:self.frame_nb]
+
+    def clear(self):
+        """Remove all the frames."""
+        self._data.view(float).fill(np.nan)
+        self.frame_nb = 0
+
+    def update(self, start, rows):
+        """Update the stats of a set of consecutive frames. The store
+        is grown if necessary.
+
+        :param start: Index of the first frame.
+
+        :param rows: Array of shape (frame_nb,
+          len(:py:const:`iris.constants.STATS_KEYS`)) as returned by
+          :py:meth:`iris.stats.StatsFile.read`.
+        """
+        end = start + rows.shape[0]
+        if end > self._data.shape[0]:
+            data = np.empty(max(end, 2 * self._data.shape[0]),
+                            dtype=self.dtype)
+            data.view(float).fill(np.nan)
+            data[:self.frame_nb] = self._data[:self.frame_nb]
+            self._data = data
+        
+        self._data[start:end] = np.ascontiguousarray(
+            rows, dtype=float).view(self.dtype).reshape(-1)
+        self.frame_nb = max(self.frame_nb, end)
+
+    def get_frame(self, index):
+        """Return the stats of a frame as a dict. An empty dict is
+        returned if the stats of the frame have not been computed.
+
+        :param index: Index of the frame.
+        """
+        frame_stats = dict()
+        if index >= self.frame_nb:
+            return frame_stats
+        row = self._data[index]
+        if np.isnan(row['odometer_nb']):
+            return frame_stats
+        for key in constants.STATS_KEYS:
+            if key in constants.STATS_INT_KEYS:
+                if not np.isnan(row[key]):
+                    frame_stats[key] = int(row[key])
+            else:
+                frame_stats[key] = float(row[key])
+        return frame_stats
+
+
+class PreviewCube(object):
+    """Full resolution view of a preview cube written by
+    :py:class:`iris.iris.Iris`.
+
+    Frames are read from the preview cube and upsampled by pixel
+    replication so that they can be displayed in place of the full
+    resolution frames. The upsampled frame is written in a single
+    buffer allocated once: a returned frame is thus only valid until
+    another frame is requested.
+    """
+
+    _frame = None # buffer of the upsampled frame
+    _index = None # index of the frame in the buffer
+
+    def __init__(self, path, binning, shape):
+        """Init class.
+
+        :param path: Path to the preview cube.
+
+        :param binning: Binning of the preview cube.
+
+        :param shape: Shape of the full resolution cube.
+        """
+        self.cube = HDFCube(path)
+        self.binning = binning
+        self.dimx, self.dimy = shape[0], shape[1]
+        self.dimz = min(shape[2], self.cube.dimz)
+        self.shape = (self.dimx, self.dimy, self.dimz)
+
+    def __getitem__(self, key):
+        """Return a part of a frame. Only one frame can be returned
+        at a time.
+
+        :param key: Tuple (x slice, y slice, frame index).
+        """
+        x, y, z = key
+        z = int(z)
+        if z != self._index:
+            frame = self.cube[:,:,z]
+            if self._frame is None:
+                # pixels on the borders which are not covered by the
+                # preview stay NaN
+                self._frame = np.empty((self.dimx, self.dimy),
+                                       dtype=frame.dtype)
+                self._frame.fill(np.nan)
+            dimx = min(self.dimx // self.binning, frame.shape[0])
+            dimy = min(self.dimy // self.binning, frame.shape[1])
+            # view of the buffer as blocks of binning x binning pixels
+            s0, s1 = self._frame.strides
+            blocks = np.lib.stride_tricks.as_strided(
+                self._frame, shape=(dimx, self.binning, dimy, self.binning),
+                strides=(s0 * self.binning, s0, s1 * self.binning, s1))
+            blocks[...] = frame[:dimx, np.newaxis, :dimy, np.newaxis]
+            self._index = z
+        return self._frame[x, y]
+
+
+class LiveCube(object):
+    """Wrapper around a cube which reads the frames available in the
+    shared memory buffer written by **iris** (see
+    :py:class:`iris.shared.SharedFrames`) instead of reading them from
+    the disk. Other frames and all the attributes are read from the
+    wrapped cube.
+    """
+
+    def __init__(self, cube, frames, camera):
+        """Init class.
+
+        :param cube: Wrapped cube (orb.core.HDFCube instance).
+
+        :param frames: :py:class:`iris.shared.SharedFrames` instance.
+
+        :param camera: Camera number (0 for the merged frame, 1 or 2).
+        """
+        self.cube = cube
+        self.frames = frames
+        self.camera = camera
+
+    def __getattr__(self, name):
+        return getattr(self.cube, name)
+
+    def __getitem__(self, key):
+        """Return a part of the cube.
+
+        :param key: Tuple (x slice, y slice, z slice or index).
+        """
+        if isinstance(key, tuple) and len(key) == 3:
+            try:
+                z = int(key[2])
+            except TypeError:
+                z = None
+            if z is not None:
+                odometer_nb = self.cube.get_frame_attribute(z, 'odometer_nb')
+                frame, seq = self.frames.get_frame(odometer_nb, self.camera)
+                if frame is not None:
+                    data = np.array(frame[key[0], key[1]])
+                    if self.frames.is_valid(seq):
+                        return data
+        return self.cube[key]
+
+
+class ViewerData(object):
+    """Data of the cube displayed by :py:class:`iris.viewer.IrisViewer`:
+    the cube itself, wrapped in a :py:class:`iris.live.LiveCube` when
+    the last frames are shared by **iris**, the stats of all the
+    frames and the preview cube.
+
+    The data is reloaded by :py:meth:`iris.live.ViewerData.set_cube`
+    each time a cube is loaded or reloaded by the viewer. It can be
+    called by the listener thread and the GTK thread.
+    """
+
+    filepath = None # path to the displayed cube
+    cube = None # displayed cube
+    daemon_port = None # listening port of the viewer daemon
+
+    statsfile_path = None # stats file path
+    statsfile = None # StatsFile instance
+    all_stats = None # StatsStore instance
+
+    preview_cube = None # PreviewCube instance of the displayed cube
+    shared_frames = None # SharedFrames instance
+
+    def __init__(self, daemon_port=None):
+        """Init class.
+
+        :param daemon_port: (Optional) Listening port of the viewer
+          daemon. The frames shared by **iris** are read only if it
+          is given (default None).
+        """
+        self.daemon_port = daemon_port
+        self._shared_lock = threading.Lock()
+
+    def load_file(self, filepath):
+        """Open a cube as :py:class:`orb.viewer.BaseViewer` does and
+        reload its data (see :py:meth:`iris.live.ViewerData.set_cube`).
+        Return the cube to display.
+
+        :param filepath: Path to the cube.
+        """
+        return self.set_cube(filepath, HDFCube(filepath))
+
+    def set_cube(self, filepath, cube):
+        """Reload the data of a cube which has just been loaded or
+        reloaded. Return the cube to display.
+
+        :param filepath: Path to the cube.
+
+        :param cube: Loaded cube (orb.core.HDFCube instance).
+        """
+        self.filepath = filepath
+        self.preview_cube = None
+        self.cube = self._share_frames(cube)
+        self.update_all_stats()
+        return self.cube
+
+    def clear_stats(self):
+        """Forget the loaded stats so that they are all read again at
+        the next reload."""
+        self.all_stats = None
+
+    def get_preview_cube(self):
+        """Return the coarsest preview of the displayed cube or None
+        if it does not exist."""
+        if self.preview_cube is None:
+            binning = max(constants.PREVIEW_BINNINGS)
+            path = utils.get_preview_path(self.filepath, binning)
+            if os.path.exists(path):
+                try:
+                    self.preview_cube = PreviewCube(path, binning,
+                                                    self.cube.shape)
+                except Exception, e:
+                    print 'Error: {}'.format(e)
+        return self.preview_cube
+
+    def _share_frames(self, cube):
+        """Return the cube wrapped in a :py:class:`iris.live.LiveCube`
+        which reads the last frames from the shared memory buffer
+        written by **iris** when they are available.
+
+        The buffer is mapped again only if it has been replaced by
+        **iris**. The previous mapping is never closed explicitly
+        because the frames displayed by the GTK thread may still point
+        into it: it is unmapped when it is not referenced anymore.
+
+        :param cube: Loaded cube.
+        """
+        if isinstance(cube, LiveCube):
+            cube = cube.cube
+        if self.daemon_port is None: return cube
+        camera = os.path.basename(self.filepath).split('.')[1]
+        if camera not in ('1', '2', 'm'): return cube
+        camera = 0 if camera == 'm' else int(camera)
+
+        # called by the listener thread and the GTK thread
+        with self._shared_lock:
+            if (self.shared_frames is None
+                or self.shared_frames.is_replaced()):
+                try:
+                    self.shared_frames = SharedFrames.open(
+                        SharedFrames.get_name(self.daemon_port))
+                except Exception, e:
+                    print 'Error: {}'.format(e)
+                    self.shared_frames = None
+
+            if self.shared_frames is not None:
+                cube = LiveCube(cube, self.shared_frames, camera)
+        return cube
+
+    def update_all_stats(self):
+        """Load all the statistics of all the frames.
+
+        The stats file is read in SWMR mode (see
+        :py:class:`iris.stats.StatsFile`) so that it can be read
+        while **iris** is writing it.
+        """
+        statsfile_path = os.path.join(
+            os.path.split(self.filepath)[0], 'iris.stats')
+        if statsfile_path != self.statsfile_path:
+            if self.statsfile is not None:
+                self.statsfile.close()
+            self.statsfile_path = statsfile_path
+            self.statsfile = StatsFile(self.statsfile_path)
+            self.all_stats = None
+        
+        if self.all_stats is None:
+            self.all_stats = StatsStore()
+
+        # the last loaded frame is read again since it may have been
+        # updated
+        start = max(self.all_stats.frame_nb - 1, 0)
+        try:
+            new_stats = self.statsfile.read(start=start)
+        except Exception, e:
+            print 'Error: {}'.format(e)
+            return
+
+        if self.statsfile.reopened and start > 0:
+            self.all_stats.clear()
+            start = 0
+            new_stats = self.statsfile.read()
+        
+        if new_stats is not None:
+            self.all_stats.update(start, new_stats)
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: scheduler.py
+
+## Copyright (c) 2010-2015 Thomas Martin <thomas.martin.1@ulaval.ca>
+##
+## This file is part of IRIS
+##
+## IRIS is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## IRIS is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+## or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+## License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import fcntl
+import json
+import time
+import atexit
+import resource
+import tempfile
+import collections
+
+import constants
+
+class ResourceScheduler(object):
+    """Share the cores of the host between the IRIS processes running
+    at the same time (e.g. live observing and reprocessing).
+
+    Each process registers in a registry file shared by all the
+    processes of the host (in :file:`/dev/shm` or in the temporary
+    directory).
+
+    * live processes (**iris**) reserve
+      :py:const:`iris.constants.SCHEDULER_LIVE_CPUS` cores each. A
+      live process analyzes only one frame but the reservation is a
+      lease, kept by name for
+      :py:const:`iris.constants.SCHEDULER_LIVE_TTL` s after each
+      registration, so that the cores stay reserved between two
+      exposures. The lease is not removed when the process exits.
+
+    * batch processes (**iris-image-mapme**, **iris-image-detrend**)
+      share the remaining cores: the number of processes they can
+      start is given by :py:meth:`ResourceScheduler.register` and
+      computed again by :py:meth:`ResourceScheduler.refresh` between
+      two work units (see
+      :py:func:`iris.scheduler.scheduled_imap`). They are
+      unregistered at exit. Their niceness is also increased by
+      :py:const:`iris.constants.SCHEDULER_BATCH_NICE` so that live
+      processes keep the priority even if batch processes already
+      running use more cores than they would be given now.
+
+    A memory budget can be given to any process. It is a budget of
+    resident memory, checked by
+    :py:meth:`ResourceScheduler.check_memory` between two work units:
+    it is not a hard limit.
+    """
+
+    LIVE = 'live'
+    BATCH = 'batch'
+    NAME = 'iris-scheduler'
+
+    def __init__(self, name, priority=BATCH, path=None):
+        """Init class.
+
+        :param name: Name of the process (e.g. 'iris-9000'). The
+          entry of a live process is kept by name.
+
+        :param priority: (Optional) 'live' or 'batch' (default
+          'batch').
+
+        :param path: (Optional) Path to the registry file. By default
+          the registry shared by all the IRIS processes of the host is
+          used (default None).
+        """
+        if priority not in (self.LIVE, self.BATCH):
+            raise ValueError("priority must be 'live' or 'batch'")
+        self.name = name
+        self.priority = priority
+        if path is None:
+            if os.path.isdir('/dev/shm'):
+                dirname = '/dev/shm'
+            else:
+                dirname = tempfile.gettempdir()
+            path = os.path.join(dirname, self.NAME)
+        self.path = path
+        self.pid = os.getpid()
+        self.ncpus = None # number of granted cores
+        self.requested_ncpus = None # number of requested cores
+        self.memory = None # memory budget in MB
+
+    def _get_key(self):
+        """Return the key of the entry of the process in the
+        registry: its name for a live process, its pid for a batch
+        process."""
+        if self.priority == self.LIVE:
+            return self.name
+        return str(self.pid)
+
+    def _update(self, func):
+        """Apply a function to the registry while it is locked and
+        write it back. Expired leases and entries of dead batch
+        processes are removed. Return the result of the function.
+
+        :param func: Function modifying the registry (a dict of
+          entries by key, see :py:meth:`ResourceScheduler._get_key`)
+          in place.
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                registry = dict()
+                if os.path.exists(self.path):
+                    with open(self.path) as f:
+                        try:
+                            registry = json.load(f)
+                        except ValueError:
+                            pass
+                now = time.time()
+                for key in list(registry):
+                    entry = registry[key]
+                    if entry.get('expires') is not None:
+                        if entry['expires'] < now:
+                            del registry[key]
+                    elif not _is_alive(int(entry.get('pid', key))):
+                        del registry[key]
+                result = func(registry)
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(registry, f)
+                os.rename(self.path + '.tmp', self.path)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _grant(self, registry):
+        """Return the number of cores the process can use and write
+        its entry in the registry.
+
+        :param registry: Registry (see
+          :py:meth:`ResourceScheduler._update`).
+        """
+        import multiprocessing
+
+        key = self._get_key()
+        if self.priority == self.LIVE:
+            granted = max(self.requested_ncpus,
+                          constants.SCHEDULER_LIVE_CPUS)
+            expires = time.time() + constants.SCHEDULER_LIVE_TTL
+        else:
+            live_ncpus = 0
+            batch_nb = 1
+            for other in registry:
+                if other == key: continue
+                if registry[other]['priority'] == self.LIVE:
+                    live_ncpus += registry[other]['ncpus']
+                else:
+                    batch_nb += 1
+            free_ncpus = max(multiprocessing.cpu_count() - live_ncpus, 1)
+            granted = max(min(self.requested_ncpus,
+                              free_ncpus // batch_nb), 1)
+            expires = None
+        registry[key] = {
+            'name': self.name, 'priority': self.priority, 'pid': self.pid,
+            'ncpus': granted, 'memory': self.memory, 'time': time.time(),
+            'expires': expires}
+        return granted
+
+    def register(self, ncpus=1, memory=None):
+        """Register the process and return the number of cores it can
+        use. The lease of a live process is renewed.
+
+        :param ncpus: (Optional) Number of cores requested. A live
+          process is always given the requested cores. A batch process
+          is given at most its share of the cores not reserved by live
+          processes (default 1).
+
+        :param memory: (Optional) Memory budget in MB. If given, the
+          resident memory of the process is checked by
+          :py:meth:`ResourceScheduler.check_memory` (default None).
+        """
+        self.requested_ncpus = max(int(ncpus), 1)
+        self.memory = memory
+
+        self.ncpus = self._update(self._grant)
+
+        if self.priority == self.BATCH:
+            atexit.register(self.unregister)
+            os.nice(constants.SCHEDULER_BATCH_NICE)
+
+        return self.ncpus
+
+    def refresh(self):
+        """Return the number of cores the process can use now.
+
+        The share of a batch process is computed again, e.g. when a
+        live process has started since the last registration. If the
+        registry cannot be updated the last number of cores is
+        returned.
+        """
+        if self.ncpus is None or self.priority == self.LIVE:
+            return self.ncpus
+        try:
+            self.ncpus = self._update(self._grant)
+        except (IOError, OSError), e:
+            print 'WARNING: scheduler registry not updated: {}'.format(e)
+        return self.ncpus
+
+    def check_memory(self):
+        """Raise a MemoryError if the resident memory of the process
+        exceeds its budget."""
+        check_memory(self.memory)
+
+    def unregister(self):
+        """Remove the process from the registry. The lease of a live
+        process can be removed this way by any process, e.g. at the
+        end of the night.
+        """
+        def _unregister(registry):
+            registry.pop(self._get_key(), None)
+        # forked workers do not unregister their parent
+        if ((self.ncpus is not None or self.priority == self.LIVE)
+            and os.getpid() == self.pid):
+            self._update(_unregister)
+            self.ncpus = None
+
+    def get_processes(self):
+        """Return the registered processes as a dict of entries
+        (name, priority, pid, ncpus, memory, time, expires) by key
+        (name of a live process, pid of a batch process)."""
+        return self._update(lambda registry: dict(registry))
+
+
+def get_rss():
+    """Return the resident memory of the process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        # maximum resident memory (in kB on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def check_memory(memory):
+    """Raise a MemoryError if the resident memory of the process
+    exceeds a budget.
+
+    :param memory: Memory budget in MB. If None, nothing is checked.
+    """
+    if memory is None: return
+    rss = get_rss()
+    if rss > memory:
+        raise MemoryError('Memory budget exceeded: {:.0f} MB used, {:.0f} MB allowed'.format(rss, memory))
+
+def _run_unit(job):
+    """Run a work unit in a worker and check the memory budget of the
+    worker once it is done.
+
+    :param job: Tuple (func, item, memory).
+    """
+    func, item, memory = job
+    result = func(item)
+    check_memory(memory)
+    return result
+
+def scheduled_imap(pool, func, iterable, scheduler=None):
+    """Equivalent of multiprocessing.Pool.imap which runs at most as
+    many work units at the same time as the number of cores given by
+    the scheduler. The number of cores is checked again each time a
+    unit is submitted and the memory budget is checked after each
+    unit, in the workers and in the process.
+
+    :param pool: multiprocessing.Pool instance. Its number of
+      processes is the maximum number of units run at the same
+      time. If None, the units are run one after the other in the
+      process.
+
+    :param func: Function applied to each item.
+
+    :param iterable: Items.
+
+    :param scheduler: (Optional) Registered
+      :py:class:`iris.scheduler.ResourceScheduler` instance. If None
+      or not registered, the number of units run at the same time is
+      the number of processes of the pool and the memory is not
+      checked (default None).
+    """
+    if scheduler is not None and scheduler.ncpus is None:
+        scheduler = None
+
+    if pool is None:
+        for item in iterable:
+            yield func(item)
+            if scheduler is not None:
+                scheduler.check_memory()
+        return
+    
+    if scheduler is None:
+        for result in pool.imap(func, iterable):
+            yield result
+        return
+    
+    pending = collections.deque()
+    for item in iterable:
+        while pending and len(pending) >= scheduler.refresh():
+            yield pending.popleft().get()
+            scheduler.check_memory()
+        pending.append(pool.apply_async(
+            _run_unit, ((func, item, scheduler.memory),)))
+    while pending:
+        yield pending.popleft().get()
+        scheduler.check_memory()
+
+
+def _is_alive(pid):
+    """Return True if a process is running.
+
+    :param pid: Process id.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: shared.py
+
+## Copyright (c) 2010-2015 Thomas Martin <thomas.martin.1@ulaval.ca>
+##
+## This file is part of IRIS
+##
+## IRIS is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## IRIS is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+## or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+## License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import tempfile
+import numpy as np
+
+import constants
+
+class SharedFrames(object):
+    """Ring buffer of the last analyzed frames in shared memory.
+
+    The buffer is a memory mapped file in :file:`/dev/shm` (or in the
+    temporary directory if :file:`/dev/shm` does not exist) written
+    by **iris** (see :py:meth:`SharedFrames.publish`) and mapped by
+    **iris-viewer** which can then display the last frames without
+    reading them from the HDF5 cubes. The buffer is removed by
+    **iris** when no viewer is listening and by **iris-viewer** when
+    it stops (see :py:meth:`SharedFrames.remove`).
+
+    Layout of the buffer:
+
+    * header (64 bytes): magic string, number of slots, frame
+      dimensions, dtype and number of published frames.
+
+    * slots: each slot starts with a small header (sequence number,
+      odometer) followed by the 3 frames (camera 1, camera 2, merged
+      frame). The sequence number is odd while the slot is being
+      written.
+    """
+
+    MAGIC = 'IRISSHM1'
+    HEADER_SIZE = 64
+    SLOT_HEADER_SIZE = 64
+
+    def __init__(self, path, mm, inode):
+        """Init class. Use :py:meth:`SharedFrames.create` or
+        :py:meth:`SharedFrames.open` to get an instance.
+
+        :param path: Path to the buffer file.
+        :param mm: mmap.mmap instance of the buffer file.
+        :param inode: Inode of the mapped file.
+        """
+        self.path = path
+        self._mm = mm
+        self.inode = inode
+        self.size = len(mm)
+        header = np.ndarray(4, dtype=np.uint32, buffer=mm, offset=8)
+        self.slot_nb = int(header[0])
+        self.dimx = int(header[1])
+        self.dimy = int(header[2])
+        self.dtype = np.dtype(str(mm[24:32]).strip('\x00'))
+        self._count = np.ndarray(1, dtype=np.uint64, buffer=mm, offset=32)
+        self._frame_size = self.dimx * self.dimy * self.dtype.itemsize
+        self._slot_size = self.SLOT_HEADER_SIZE + 3 * self._frame_size
+
+    @staticmethod
+    def get_name(port):
+        """Return the name of the buffer shared by the **iris**
+        processes and the viewer listening on a given port.
+
+        :param port: Listening port of the viewer daemon.
+        """
+        return 'iris-{}'.format(port)
+
+    @staticmethod
+    def get_path(name):
+        """Return the path to the buffer file of a given name.
+
+        :param name: Name of the buffer.
+        """
+        if os.path.isdir('/dev/shm'):
+            dirname = '/dev/shm'
+        else:
+            dirname = tempfile.gettempdir()
+        return os.path.join(dirname, name)
+
+    @classmethod
+    def create(cls, name, shape, dtype, slot_nb=constants.SHARED_SLOT_NB):
+        """Create a new buffer or return the existing one if it has the
+        same layout.
+
+        :param name: Name of the buffer.
+
+        :param shape: Shape of the frames.
+
+        :param dtype: Data type of the frames.
+
+        :param slot_nb: (Optional) Number of frames kept in the buffer
+          (default :py:const:`iris.constants.SHARED_SLOT_NB`).
+        """
+        path = cls.get_path(name)
+        dtype = np.dtype(dtype)
+        try:
+            frames = cls.open(name)
+            if frames is not None:
+                if (frames.slot_nb == slot_nb
+                    and (frames.dimx, frames.dimy) == tuple(shape[:2])
+                    and frames.dtype == dtype):
+                    return frames
+                frames.close()
+        except Exception:
+            pass
+
+        # the file is replaced: readers keep the old mapping until
+        # they reopen it
+        if os.path.exists(path):
+            os.remove(path)
+        size = (cls.HEADER_SIZE + slot_nb * (
+            cls.SLOT_HEADER_SIZE + 3 * shape[0] * shape[1] * dtype.itemsize))
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            mm = mmap.mmap(f.fileno(), size)
+            inode = os.fstat(f.fileno()).st_ino
+        mm[8:20] = np.array([slot_nb, shape[0], shape[1]],
+                            dtype=np.uint32).tostring()
+        mm[24:32] = dtype.str.ljust(8, '\x00')
+        mm[0:8] = cls.MAGIC
+        return cls(path, mm, inode)
+
+    @classmethod
+    def remove(cls, name):
+        """Remove a buffer. The processes which have mapped it can
+        still read it until they unmap it.
+
+        :param name: Name of the buffer.
+        """
+        path = cls.get_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @classmethod
+    def open(cls, name):
+        """Map an existing buffer. Return None if it does not exist.
+
+        :param name: Name of the buffer.
+        """
+        path = cls.get_path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+            inode = os.fstat(f.fileno()).st_ino
+        if mm[0:8] != cls.MAGIC:
+            mm.close()
+            return None
+        return cls(path, mm, inode)
+
+    def is_replaced(self):
+        """Return True if the buffer file has been replaced or removed
+        since it was mapped (e.g. when **iris** creates a buffer with
+        another layout)."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_size) != (self.inode, self.size)
+
+    def close(self):
+        """Unmap the buffer.
+
+        .. warning:: The views returned by
+           :py:meth:`SharedFrames.get_frame` must not be used anymore
+           once the buffer is unmapped. A buffer which may still be
+           read by another thread must not be closed: it is unmapped
+           when it is not referenced anymore.
+        """
+        self._mm.close()
+
+    def _get_slot(self, islot):
+        """Return the header and the frames of a slot as views of the
+        buffer.
+
+        :param islot: Slot index.
+        """
+        offset = self.HEADER_SIZE + islot * self._slot_size
+        header = np.ndarray(2, dtype=np.int64, buffer=self._mm,
+                            offset=offset)
+        frames = np.ndarray((3, self.dimx, self.dimy), dtype=self.dtype,
+                            buffer=self._mm,
+                            offset=offset + self.SLOT_HEADER_SIZE)
+        return header, frames
+
+    def publish(self, odometer_nb, im1, im2, imM):
+        """Write the frames of a new exposure in the next slot.
+
+        :param odometer_nb: Odometer of the frame.
+        :param im1: Frame of the camera 1.
+        :param im2: Frame of the camera 2.
+        :param imM: Merged frame.
+        """
+        islot = int(self._count[0]) % self.slot_nb
+        header, frames = self._get_slot(islot)
+        seq = header[0] // 2 * 2 + 1
+        header[0] = seq # odd: slot is being written
+        header[1] = odometer_nb
+        frames[0] = im1
+        frames[1] = im2
+        frames[2] = imM
+        header[0] = seq + 1
+        self._count[0] += 1
+
+    def get_frame(self, odometer_nb, camera):
+        """Return a view of a frame of the buffer and its sequence
+        number or (None, None) if it is not in the buffer.
+
+        The view may be overwritten at any time by the writer. The
+        data read from it must be validated afterwards with
+        :py:meth:`SharedFrames.is_valid`.
+
+        :param odometer_nb: Odometer of the frame.
+
+        :param camera: Camera number (0 for the merged frame, 1 or 2).
+        """
+        for islot in range(self.slot_nb):
+            header, frames = self._get_slot(islot)
+            seq = int(header[0])
+            if seq > 0 and seq % 2 == 0 and header[1] == odometer_nb:
+                return frames[(camera + 2) % 3], (islot, seq)
+        return None, None
+
+    def is_valid(self, seq):
+        """Return True if a slot has not been modified since
+        :py:meth:`SharedFrames.get_frame` returned its sequence number.
+
+        :param seq: Sequence number returned by
+          :py:meth:`SharedFrames.get_frame`.
+        """
+        header = self._get_slot(seq[0])[0]
+        return int(header[0]) == seq[1]
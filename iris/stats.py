@@ -21,20 +21,45 @@
 ## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
 
 # IMPORT CORE
+# orb.astrometry, orb.utils.image and orb.data are imported in the
+# methods using them to keep the import of this module fast.
 from orb.core import Tools
-from orb.astrometry import Astrometry, StarsParams, Aligner
-import orb.utils.image
-import orb.data as od
 import constants
+import utils
 
 # OTHER IMPORTS
 import math
 import os
 import numpy as np
 import time
+import glob
+import h5py
 
+# HDF5 file locking can be disabled for a single file only with h5py
+# >= 3.5
+_H5PY_LOCKING = tuple(h5py.version.version_tuple[:2]) >= (3, 5)
 
-class ImageStats(Tools):
+def _add_stat(stats, name, data):
+    """Add a value and its uncertainty to a dict of stats.
+
+    :param stats: Dict of stats.
+    :param name: Name of the stat.
+    :param data: orb.data.Data instance.
+    """
+    stats[name] = data.dat
+    stats[name + '_err'] = data.err
+
+
+def _get_stats_keys(dset):
+    """Return the keys of the columns of the stats dataset as a
+    tuple.
+
+    :param dset: Stats dataset (see :py:class:`iris.stats.StatsFile`).
+    """
+    return tuple(str(key) for key in dset.attrs.get('keys', ()))
+
+
+class ImageStats(utils.ConfigCache, Tools):
     """Compute quality parameters of a SITELLE image.
 
     Computed parameters are: FWHM of both cameras, sky background,
@@ -51,12 +76,19 @@ class ImageStats(Tools):
     dimy = None # image Y size
     shape = None # image shape
     star_nb = None # star number
+    fitted_star_nb = None # number of stars used to compute the stats
     odometer_nb = None # odometer of the frame
+    dtype = None # data type of the frames
+    quality_flag = None # 0 if the frame passed the quality check
+    peak_snr = None # median peak SNR of the checked stars
+    sky = None # median sky level around the checked stars
+    frame_path = None # path to the file where the frame data is recorded
 
     kwargs = None # Passed keyword arguments
     
     def __init__(self, image_path, force_refresh=False,
-                 **kwargs):
+                 ref_star_nb=constants.REF_STAR_NB, frames=None,
+                 use_cache=True, dtype=constants.DATA_DTYPE, **kwargs):
         """Init class.
 
         .. note:: Initialization steps:
@@ -66,20 +98,48 @@ class ImageStats(Tools):
               
            2. Create a merged frame equal to CAM1 + CAM2
         
-        :param image_path: Path to a SITELLE raw image.
+        :param image_path: Path to a SITELLE raw image. Can be None
+          if frames is given.
 
         :param force_refresh: (Optional) If True the given image is
           considered to be a reference image ad all previous files are
           erased (default False).
 
+        :param ref_star_nb: (Optional) Maximum number of reference
+          stars kept when a reference image is analyzed. If None, all
+          the detected stars are kept (default
+          :py:const:`iris.constants.REF_STAR_NB`).
+
+        :param frames: (Optional) Tuple (cam1, cam2, header) of
+          already loaded data. If given, image_path is not read (see
+          :py:meth:`iris.stats.ImageStats.from_arrays`, default None).
+
+        :param use_cache: (Optional) If True, the alignment
+          parameters and the reference stars of a reference image are
+          taken from the solution computed for the same pointing if
+          it is still valid (see :py:class:`iris.stats.SolutionCache`,
+          default True).
+
+        :param dtype: (Optional) Data type of the frames. The frames
+          are converted when read and the merged frame is created
+          with this type (default
+          :py:const:`iris.constants.DATA_DTYPE`).
+
         :param kwargs: Keyword arguments of orb.core.Tools class (see
           ORB documentation).      
         """
+        import orb.astrometry
+        import orb.utils.image
 
-        kwargs['config_file_name'] = 'config.sitelle.orb'
+        # the configuration parameters are read only once per process
+        Astrometry = utils.with_config_cache(orb.astrometry.Astrometry)
+        Aligner = utils.with_config_cache(orb.astrometry.Aligner)
+
+        kwargs['config_file_name'] = constants.CONFIG_FILE_NAME
 
         Tools.__init__(self, **kwargs)
         self.kwargs = kwargs
+        config = utils.get_sitelle_config(self)
 
         self.image_path = image_path
 
@@ -97,41 +157,84 @@ class ImageStats(Tools):
 
 
         # read images
-        self.im1, self.hdr = self.read_fits(image_path, image_mode='sitelle',
-                                            chip_index=1, return_header=True)
-        self.im2 = self.read_fits(image_path, image_mode='sitelle',
+        self.dtype = np.dtype(dtype)
+        if frames is None:
+            cam1, self.hdr = self.read_fits(
+                image_path, image_mode='sitelle',
+                chip_index=1, return_header=True)
+            cam2 = self.read_fits(image_path, image_mode='sitelle',
                                   chip_index=2)
+        else:
+            cam1, cam2, self.hdr = frames
+        self.im1 = np.asarray(cam1, dtype=self.dtype)
+        self.im2 = np.asarray(cam2, dtype=self.dtype)
+        del cam1, cam2
+        if self.im1.shape != self.im2.shape:
+            self._print_error('cam1 and cam2 must have the same shape')
         
         self.dimx = self.im1.shape[0]
         self.dimy = self.im1.shape[1]
         self.shape = self.im1.shape
         
         self.odometer_nb = int(self._get_hdr_keyword('EXPNUM'))
+        self.frame_path = self.reffile.register(self.odometer_nb,
+                                                ref=self.refresh)
 
-        fov = float(self._get_config_parameter('FIELD_OF_VIEW_1'))
-        fwhm_arc = float(self._get_config_parameter('INIT_FWHM'))
-        pix_size = float(self._get_config_parameter('PIX_SIZE_CAM1'))
+        fov = config.field_of_view_1
+        fwhm_arc = config.init_fwhm
+        pix_size = config.pix_size_cam1
         
         # find alignment parameters if nescessary
         if self.refresh:
             start_time = time.time()
-            self._print_msg('Computing alignment parameters')
-            init_angle = float(self._get_config_parameter('INIT_ANGLE'))
-            init_dx = float(self._get_config_parameter('INIT_DX'))
-            init_dy = float(self._get_config_parameter('INIT_DY'))
-            aligner = Aligner(self.im1, self.im2, fwhm_arc, fov, fov, 1, 1,
-                              pix_size, pix_size, init_angle, init_dx, init_dy,
-                              overwrite=True, **kwargs)
-            result = aligner.compute_alignment_parameters(
-                correct_distorsion=False,
-                brute_force=True)
-
-            self.reffile.append('align-params', result['coeffs'])
-            self.reffile.append('star-list2', result['star_list2'])
-            self.reffile.append('star-list1', result['star_list1'])
-            self.reffile.append('fwhm-arc', result['fwhm_arc2'])
-            self.reffile.append('rc', result['rc'])
-            self.reffile.append('zoom-factor', result['zoom_factor'])
+            solutions = SolutionCache(self._get_solution_cache_path())
+            pointing = self._get_pointing()
+            solution = None
+            if use_cache and pointing is not None:
+                solution = solutions.get(pointing, ref_star_nb)
+                if solution is not None:
+                    self._print_msg('Validating cached alignment parameters')
+                    # any error (e.g. a failed fit) invalidates the
+                    # cached solution
+                    try:
+                        solution = self._validate_solution(
+                            solution, fwhm_arc, fov)
+                    except Exception, e:
+                        self._print_warning('Cached solution rejected: {}'.format(e))
+                        solution = None
+            
+            if solution is None:
+                self._print_msg('Computing alignment parameters')
+                aligner = Aligner(self.im1, self.im2, fwhm_arc, fov, fov,
+                                  1, 1, pix_size, pix_size,
+                                  config.init_angle,
+                                  config.init_dx, config.init_dy,
+                                  overwrite=True, **kwargs)
+                result = aligner.compute_alignment_parameters(
+                    correct_distorsion=False,
+                    brute_force=True)
+
+                fwhm_pix = result['fwhm_arc2'] / (
+                    fov * 60. / max(self.dimx, self.dimy))
+                selection = self._select_reference_stars(
+                    result['star_list1'], fwhm_pix, ref_star_nb)
+                self._print_msg('{} reference stars selected over {}'.format(
+                    selection.shape[0], result['star_list1'].shape[0]))
+
+                solution = {
+                    'align-params': result['coeffs'],
+                    'star-list2-all': result['star_list2'],
+                    'star-list1-all': result['star_list1'],
+                    'star-list2': result['star_list2'][selection],
+                    'star-list1': result['star_list1'][selection],
+                    'fwhm-arc': result['fwhm_arc2'],
+                    'rc': result['rc'],
+                    'zoom-factor': result['zoom_factor']}
+                if pointing is not None:
+                    solutions.add(pointing, ref_star_nb, solution)
+
+            for key in solution:
+                self.reffile.append(key, solution[key])
             self.reffile.append('ref-odometer', self.odometer_nb)
             
             self._print_msg('Alignment parameters ({}) computed  in {:.2f} s'.format(self.reffile.get('align-params'), time.time() - start_time))
@@ -144,38 +247,52 @@ class ImageStats(Tools):
         self.astro2.reset_fwhm_arc(self.reffile.get('fwhm-arc'))
 
 
-        # creating merged frame
-        align_params = self.reffile.get('align-params')
-        self._print_msg('Creating merged frame')
-        start_time = time.time()
-        self.imM = np.empty_like(self.im1)
-        self.imM.fill(np.nan)
-        xmin = list() ; ymin = list() ; xmax = list() ; ymax = list()
+        # check the frame quality before building the merged frame
+        # and fitting the stars
+        self.peak_snr, self.sky = self._measure_quality()
+        self.quality_flag = 0
+        if self.refresh:
+            self.reffile.append('ref-snr', self.peak_snr)
+        else:
+            self.quality_flag = self._get_quality_flag()
+
+        if self.quality_flag:
+            self._print_warning('Bad frame quality (flag {}, peak SNR: {:.2f}, sky: {:.2f}): merged frame not created'.format(self.quality_flag, self.peak_snr, self.sky))
+            self.imM = np.empty_like(self.im1)
+            self.imM.fill(np.nan)
+        else:
+            # creating merged frame
+            align_params = self.reffile.get('align-params')
+            self._print_msg('Creating merged frame')
+            start_time = time.time()
+            self.imM = np.empty_like(self.im1)
+            self.imM.fill(np.nan)
+            xmin = list() ; ymin = list() ; xmax = list() ; ymax = list()
         
-        for istar in range(self.astro1.star_list.shape[0]):
-            ix, iy = self.astro1.star_list[istar, :]
-            _xmin, _xmax, _ymin, _ymax = orb.utils.image.get_box_coords(
-                ix, iy,
-                self.astro1.fwhm_pix * 15,
-                0, self.dimx, 0, self.dimy)
-            xmin.append(_xmin) ; ymin.append(_ymin)
-            xmax.append(_xmax) ; ymax.append(_ymax)
-
-
-        sections = orb.utils.image.transform_frame(
-            self.im2,
-            xmin, xmax, ymin, ymax,
-            self.reffile.get('align-params'),
-            self.reffile.get('rc'),
-            self.reffile.get('zoom-factor'), 1)
-
-        for isec in range(len(sections)):
-            self.imM[xmin[isec]:xmax[isec], ymin[isec]:ymax[isec]] = (
-                self.im1[xmin[isec]:xmax[isec], ymin[isec]:ymax[isec]]
-                + sections[isec])
+            for istar in range(self.astro1.star_list.shape[0]):
+                ix, iy = self.astro1.star_list[istar, :]
+                _xmin, _xmax, _ymin, _ymax = orb.utils.image.get_box_coords(
+                    ix, iy,
+                    self.astro1.fwhm_pix * 15,
+                    0, self.dimx, 0, self.dimy)
+                xmin.append(_xmin) ; ymin.append(_ymin)
+                xmax.append(_xmax) ; ymax.append(_ymax)
+
+
+            sections = orb.utils.image.transform_frame(
+                self.im2,
+                xmin, xmax, ymin, ymax,
+                self.reffile.get('align-params'),
+                self.reffile.get('rc'),
+                self.reffile.get('zoom-factor'), 1)
+
+            for isec in range(len(sections)):
+                self.imM[xmin[isec]:xmax[isec], ymin[isec]:ymax[isec]] = (
+                    self.im1[xmin[isec]:xmax[isec], ymin[isec]:ymax[isec]]
+                    + sections[isec])
             
-        self._print_msg('Merged frame created in {:.2f} s'.format(
-            time.time() - start_time))
+            self._print_msg('Merged frame created in {:.2f} s'.format(
+                time.time() - start_time))
         
         # init astrometry of merged frame
         self.astroM = Astrometry(self.imM, fwhm_arc, fov, **kwargs)
@@ -185,11 +302,204 @@ class ImageStats(Tools):
         self.star_nb = self.reffile.get('star-list1').shape[0]
 
       
+    @classmethod
+    def from_arrays(cls, cam1, cam2, hdr, **kwargs):
+        """Init class from already loaded data instead of a FITS file.
+
+        :param cam1: Image of the camera 1 (same orientation as the
+          one returned by orb.core.Tools.read_fits with
+          chip_index=1).
+
+        :param cam2: Image of the camera 2 (same orientation as the
+          one returned by orb.core.Tools.read_fits with
+          chip_index=2).
+
+        :param hdr: Image header. Can be a simple dict but must
+          contain the keyword EXPNUM.
+
+        :param kwargs: Keyword arguments of
+          :py:meth:`iris.stats.ImageStats.__init__`.
+        """
+        return cls(None, frames=(cam1, cam2, hdr), **kwargs)
+
+    def _select_reference_stars(self, star_list, fwhm_pix, star_nb):
+        """Return the indexes of the best reference stars, sorted by
+        decreasing quality.
+
+        Stars are ranked by their SNR in camera 1, weighted down when
+        they are close to another star or to the edge of the chip.
+
+        :param star_list: Positions of the stars in camera 1.
+
+        :param fwhm_pix: FWHM of the stars in pixels.
+
+        :param star_nb: Maximum number of stars to keep. If None,
+          all the stars are kept.
+        """
+        import orb.utils.image
+
+        star_list = np.array(star_list, dtype=float)
+        box_size = max(int(fwhm_pix * 5), 3)
+
+        snr = np.zeros(star_list.shape[0], dtype=float)
+        for istar in range(star_list.shape[0]):
+            ix, iy = star_list[istar, :]
+            xmin, xmax, ymin, ymax = orb.utils.image.get_box_coords(
+                ix, iy, box_size, 0, self.dimx, 0, self.dimy)
+            box = self.im1[xmin:xmax, ymin:ymax]
+            if box.size == 0 or np.all(np.isnan(box)):
+                continue
+            sky = np.nanmedian(box)
+            noise = 1.4826 * np.nanmedian(np.abs(box - sky))
+            if noise > 0:
+                snr[istar] = (np.nanmax(box) - sky) / noise
+
+        # distance to the nearest star
+        isolation = np.empty(star_list.shape[0], dtype=float)
+        for istar in range(star_list.shape[0]):
+            dist = np.sqrt(np.sum((star_list - star_list[istar]) ** 2,
+                                  axis=1))
+            dist[istar] = np.inf
+            isolation[istar] = np.min(dist) / fwhm_pix
+
+        # distance to the edge of the chip
+        edge = np.min(np.array([star_list[:,0],
+                                star_list[:,1],
+                                self.dimx - star_list[:,0],
+                                self.dimy - star_list[:,1]]),
+                      axis=0) / fwhm_pix
+
+        score = (snr
+                 * np.clip(isolation / constants.REF_STAR_ISOLATION, 0, 1)
+                 * np.clip(edge / constants.REF_STAR_EDGE, 0, 1))
+        
+        return np.argsort(score)[::-1][:star_nb]
+      
     def _get_reference_file_path(self):
         """Return the reference file path."""
         return self._data_prefix + 'iris.ref'
 
 
+    def _get_solution_cache_path(self):
+        """Return the path to the cache of reference solutions."""
+        return self._data_prefix + 'iris.solutions'
+
+    def _get_pointing(self):
+        """Return the pointing of the image as a tuple (RA, DEC,
+        filter, binning) or None if it is not given by the header.
+        """
+        try:
+            return (float(self.hdr['RA_DEG']), float(self.hdr['DEC_DEG']),
+                    str(self.hdr['FILTER']).strip(),
+                    '{}x{}'.format(int(self.hdr['CCDBIN1']),
+                                   int(self.hdr['CCDBIN2'])))
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def _validate_solution(self, solution, fwhm_arc, fov):
+        """Fit the best reference stars of a cached solution in both
+        cameras. Return the solution with the star lists corrected
+        from the measured shift or None if it is not valid anymore.
+
+        :param solution: Dict of the datasets of the solution (see
+          :py:meth:`iris.stats.SolutionCache.get`).
+
+        :param fwhm_arc: Initial FWHM (in arcseconds).
+
+        :param fov: Field of view (in arcminutes).
+
+        .. note:: Errors (e.g. a failed fit) are not caught: they
+           must be considered as an invalid solution by the caller.
+        """
+        import orb.astrometry
+
+        Astrometry = utils.with_config_cache(orb.astrometry.Astrometry)
+
+        star_nb = min(constants.REF_CACHE_CHECK_STAR_NB,
+                      solution['star-list1'].shape[0])
+        shifts = list()
+        for im, key in ((self.im1, 'star-list1'), (self.im2, 'star-list2')):
+            star_list = solution[key][:star_nb]
+            astro = Astrometry(im, fwhm_arc, fov, **self.kwargs)
+            astro.reset_star_list(star_list)
+            astro.reset_fwhm_arc(solution['fwhm-arc'])
+            fit = astro.fit_stars_in_frame(0, multi_fit=True,
+                                           estimate_local_noise=False,
+                                           no_aperture_photometry=True)
+            dx = np.squeeze(fit[:, 'x']) - star_list[:,0]
+            dy = np.squeeze(fit[:, 'y']) - star_list[:,1]
+            ok = np.isfinite(dx) * np.isfinite(dy)
+            if np.sum(ok) < constants.REF_CACHE_MIN_FIT_RATIO * star_nb:
+                self._print_warning('Cached solution rejected: only {}/{} stars fitted'.format(np.sum(ok), star_nb))
+                return None
+            shift = np.median(dx[ok]), np.median(dy[ok])
+            if np.hypot(*shift) > constants.REF_CACHE_MAX_SHIFT:
+                self._print_warning('Cached solution rejected: stars shifted by {:.2f} pixels'.format(np.hypot(*shift)))
+                return None
+            shifts.append(np.array(shift))
+
+        solution = dict(solution)
+        for key, shift in (('star-list1', shifts[0]),
+                           ('star-list2', shifts[1])):
+            solution[key] = solution[key] + shift
+            solution[key + '-all'] = solution[key + '-all'] + shift
+        self._print_msg('Cached solution validated (shifts: {}, {})'.format(
+            shifts[0], shifts[1]))
+        return solution
+
+    def _measure_quality(self):
+        """Return the median peak SNR and the median sky level
+        measured in camera 1 on small stamps around the best reference
+        stars.
+
+        Only :py:const:`iris.constants.QUALITY_STAR_NB` stars are
+        measured so that the check is much faster than a fit. The sky
+        level and the noise are estimated from the border of each
+        stamp.
+        """
+        import orb.utils.image
+
+        star_list = self.reffile.get('star-list1')[
+            :constants.QUALITY_STAR_NB]
+        box_size = max(int(self.astro1.fwhm_pix * 6), 7)
+        snr = list()
+        sky = list()
+        for istar in range(star_list.shape[0]):
+            ix, iy = star_list[istar, :]
+            xmin, xmax, ymin, ymax = orb.utils.image.get_box_coords(
+                ix, iy, box_size, 0, self.dimx, 0, self.dimy)
+            box = self.im1[xmin:xmax, ymin:ymax]
+            if box.shape[0] < 3 or box.shape[1] < 3:
+                continue
+            border = np.concatenate((box[0,:], box[-1,:],
+                                     box[1:-1,0], box[1:-1,-1]))
+            border = border[np.isfinite(border)]
+            if border.size < 3 or not np.any(np.isfinite(box)):
+                continue
+            bkg = np.median(border)
+            noise = 1.4826 * np.median(np.abs(border - bkg))
+            if noise <= 0:
+                continue
+            snr.append((np.nanmax(box) - bkg) / noise)
+            sky.append(bkg)
+
+        if len(snr) == 0:
+            return np.nan, np.nan
+        return float(np.median(snr)), float(np.median(sky))
+
+    def _get_quality_flag(self):
+        """Return the quality flag of the frame: 0 if the frame can be
+        analyzed, else :py:const:`iris.constants.QUALITY_LOW_SNR` or
+        :py:const:`iris.constants.QUALITY_SNR_DROP`.
+        """
+        if not (self.peak_snr >= constants.QUALITY_MIN_SNR):
+            return constants.QUALITY_LOW_SNR
+        ref_snr = self.reffile.get('ref-snr')
+        if ref_snr is not None and ref_snr > 0:
+            if self.peak_snr / ref_snr < constants.QUALITY_MIN_SNR_RATIO:
+                return constants.QUALITY_SNR_DROP
+        return 0
+
     def _get_hdr_keyword(self, key):
         """Return the value of a keyword in the header of the image."""
         if key in self.hdr:
@@ -222,8 +532,148 @@ class ImageStats(Tools):
         
 
 
-    def compute_stats(self):
-        """Compute stats of the image for both cameras."""
+    def _get_star_order(self):
+        """Return the indexes of the reference stars sorted by
+        decreasing brightness.
+
+        The brightness of a star is estimated from the maximum of the
+        camera 1 image in a small box around its position.
+        """
+        import orb.utils.image
+
+        star_list = self.reffile.get('star-list1')
+        box_size = max(int(self.astro1.fwhm_pix * 2), 1)
+        peaks = np.empty(star_list.shape[0], dtype=float)
+        for istar in range(star_list.shape[0]):
+            ix, iy = star_list[istar, :]
+            xmin, xmax, ymin, ymax = orb.utils.image.get_box_coords(
+                ix, iy, box_size, 0, self.dimx, 0, self.dimy)
+            box = self.im1[xmin:xmax, ymin:ymax]
+            if box.size > 0 and np.any(~np.isnan(box)):
+                peaks[istar] = np.nanmax(box)
+            else:
+                peaks[istar] = -np.inf
+        return np.argsort(peaks)[::-1]
+
+    def _compute_stats_with_deadline(self, deadline, callback=None):
+        """Fit stars by chunks, in decreasing brightness order, until
+        the deadline is reached.
+
+        Each chunk is fitted in camera 1, camera 2 and in the merged
+        frame so that all the stats are computed from the same
+        stars. A new chunk is started only if it is expected to end
+        before the deadline. At least one chunk is always fitted.
+
+        :param deadline: Time (as returned by :py:meth:`time.time`)
+          at which the fit must be stopped.
+
+        :param callback: (Optional) Function called for each stage
+          (see :py:meth:`iris.stats.ImageStats.compute_stats`, default
+          None).
+        """
+        import orb.astrometry
+
+        StarsParams = utils.with_config_cache(orb.astrometry.StarsParams)
+
+        star_list1 = self.reffile.get('star-list1')
+        star_list2 = self.reffile.get('star-list2')
+        order = self._get_star_order()
+
+        fit1 = StarsParams(self.star_nb, 1, **self.kwargs)
+        fit2 = StarsParams(self.star_nb, 1, **self.kwargs)
+        fitM = StarsParams(self.star_nb, 1, **self.kwargs)
+
+        start_time = time.time()
+        chunk_time = 0.
+        self.fitted_star_nb = 0
+        for ichunk in range(0, self.star_nb, constants.DEADLINE_STAR_CHUNK):
+            if (self.fitted_star_nb > 0
+                and time.time() + chunk_time > deadline):
+                self._print_warning(
+                    'Deadline reached: {}/{} stars fitted'.format(
+                        self.fitted_star_nb, self.star_nb))
+                break
+
+            chunk_start_time = time.time()
+            istars = order[ichunk:ichunk + constants.DEADLINE_STAR_CHUNK]
+
+            self.astro1.reset_star_list(star_list1[istars])
+            cfit1 = self.astro1.fit_stars_in_frame(
+                0, multi_fit=True, estimate_local_noise=False,
+                no_aperture_photometry=True)
+            self.astro2.reset_star_list(star_list2[istars])
+            cfit2 = self.astro2.fit_stars_in_frame(
+                0, multi_fit=True, estimate_local_noise=False,
+                no_aperture_photometry=True)
+            self.astroM.reset_star_list(star_list1[istars])
+            cfitM = self.astroM.fit_stars_in_frame(0, no_fit=True)
+
+            for i in range(len(istars)):
+                fit1[istars[i], 0] = cfit1[i, 0]
+                fit2[istars[i], 0] = cfit2[i, 0]
+                fitM[istars[i], 0] = cfitM[i, 0]
+
+            self.fitted_star_nb += len(istars)
+            chunk_time = time.time() - chunk_start_time
+
+        self._print_msg('{} stars fitted in {:.2f} s'.format(
+            self.fitted_star_nb, time.time() - start_time))
+
+        # restore complete star lists
+        self.astro1.reset_star_list(star_list1)
+        self.astro2.reset_star_list(star_list2)
+        self.astroM.reset_star_list(star_list1)
+
+        fit1.save_stars_params(self.frame_path,
+                               self._get_stars_params_group(1))
+        fit2.save_stars_params(self.frame_path,
+                               self._get_stars_params_group(2))
+        fitM.save_stars_params(self.frame_path,
+                               self._get_stars_params_group(0))
+
+        if callback is not None:
+            callback('cam1', self._get_camera_stats(1, fit1))
+            callback('cam2', self._get_camera_stats(2, fit2))
+            callback('merged', self._get_merged_stats(fitM))
+
+    def compute_stats(self, deadline=None, callback=None):
+        """Compute stats of the image for both cameras.
+
+        :param deadline: (Optional) Time (as returned by
+          :py:meth:`time.time`) at which the fit of the stars must be
+          stopped. The stats are then computed from the brightest
+          stars fitted so far. Ignored for a reference image which
+          must be fitted completely (default None).
+
+        :param callback: (Optional) Function called as soon as a
+          stage is finished with the name of the stage ('quality',
+          'cam1', 'cam2' or 'merged') and a dict of the stats computed
+          from this stage. The 'quality' stage is finished before the
+          stars are fitted. In deadline mode the other stages end
+          together (default None).
+        """
+        if callback is not None:
+            callback('quality', {'odometer_nb': self.odometer_nb,
+                                 'quality_flag': self.quality_flag,
+                                 'peak-snr': self.peak_snr,
+                                 'sky': self.sky})
+
+        if self.quality_flag:
+            self._print_warning('Stars not fitted because of bad frame quality')
+            self.fitted_star_nb = 0
+            if callback is not None:
+                for stage in ('cam1', 'cam2', 'merged'):
+                    callback(stage, {'odometer_nb': self.odometer_nb})
+            return
+        
+        if deadline is not None:
+            if not self.refresh:
+                self._compute_stats_with_deadline(deadline,
+                                                  callback=callback)
+                return
+            self._print_warning('Deadline ignored for a reference image')
+
+        self.fitted_star_nb = self.star_nb
 
         # stars fit
         start_time = time.time()
@@ -233,8 +683,10 @@ class ImageStats(Tools):
                                               no_aperture_photometry=True)
         self._print_msg('Stars fitted in {:.2f} s'.format(
             time.time() - start_time))
-        fit1.save_stars_params(self._get_reference_file_path(),
+        fit1.save_stars_params(self.frame_path,
                                self._get_stars_params_group(1))
+        if callback is not None:
+            callback('cam1', self._get_camera_stats(1, fit1))
         
         start_time = time.time()
         self._print_msg('Fitting_stars in camera 2')
@@ -243,130 +695,171 @@ class ImageStats(Tools):
                                               no_aperture_photometry=True)
         self._print_msg('Stars fitted in {:.2f} s'.format(
             time.time() - start_time))
-        fit2.save_stars_params(self._get_reference_file_path(),
+        fit2.save_stars_params(self.frame_path,
                                self._get_stars_params_group(2))
+        if callback is not None:
+            callback('cam2', self._get_camera_stats(2, fit2))
 
         start_time = time.time()
         self._print_msg('Getting star photometry on merged frame')
         fitM = self.astroM.fit_stars_in_frame(0, no_fit=True)
         self._print_msg('Photometry computed in {:.2f} s'.format(
             time.time() - start_time))
-        fitM.save_stars_params(self._get_reference_file_path(),
+        fitM.save_stars_params(self.frame_path,
                                self._get_stars_params_group(0))
+        if callback is not None:
+            callback('merged', self._get_merged_stats(fitM))
         
 
-    def get_stats(self):
-        """Return the computed stats in a nice human readable form as
-        a dict."""
+    def _load_stars_params(self, camera, ref=False):
+        """Load the fitted stars parameters of a camera.
 
-        def add_data(name, data):
-            stats[name] = data.dat
-            stats[name + '_err'] = data.err
-            
-        fit1 = StarsParams(self.star_nb, 1, **self.kwargs)
-        fit1.load_stars_params(self._get_reference_file_path(),
-                               self._get_stars_params_group(1))
-        fit2 = StarsParams(self.star_nb, 1, **self.kwargs)
-        fit2.load_stars_params(self._get_reference_file_path(),
-                               self._get_stars_params_group(2))
-        fitM = StarsParams(self.star_nb, 1, **self.kwargs)
-        fitM.load_stars_params(self._get_reference_file_path(),
-                               self._get_stars_params_group(0))
-        
-        fitR1 = StarsParams(self.star_nb, 1, **self.kwargs)
-        fitR1.load_stars_params(self._get_reference_file_path(),
-                                self._get_stars_params_group(1, ref=True))
-        fitR2 = StarsParams(self.star_nb, 1, **self.kwargs)
-        fitR2.load_stars_params(self._get_reference_file_path(),
-                                self._get_stars_params_group(2, ref=True))
-        fitRM = StarsParams(self.star_nb, 1, **self.kwargs)
-        fitRM.load_stars_params(self._get_reference_file_path(),
-                                self._get_stars_params_group(0, ref=True))
-        
+        :param camera: Camera number, can be 0, 1 or 2.
 
-        ## compute stats from fit 
-        stats = dict()
+        :param ref: (Optional) If True, the parameters of the
+          reference image are loaded (default False).
+        """
+        import orb.astrometry
 
-        # dx 1
-        if self.refresh:
-            dx1 = od.array(0., fit1[:,'x_err'][0])
-        else:
-            x1 = od.array(fit1[:,'x'][0], fit1[:,'x_err'][0])
-            x1_ref = od.array(fitR1[:,'x'][0], fitR1[:,'x_err'][0])
-            dx1 = x1 - x1_ref
-        add_data('dx-pix-1', dx1)
+        StarsParams = utils.with_config_cache(orb.astrometry.StarsParams)
 
-        # dx 2
-        if self.refresh:
-            dx2 = od.array(0., fit2[:,'x_err'][0])
+        fit = StarsParams(self.star_nb, 1, **self.kwargs)
+        if ref:
+            fit.load_stars_params(self._get_reference_file_path(),
+                                  self._get_stars_params_group(
+                                      camera, ref=True))
         else:
-            x2 = od.array(fit2[:,'x'][0], fit2[:,'x_err'][0])
-            x2_ref = od.array(fitR2[:,'x'][0], fitR2[:,'x_err'][0])
-            dx2 = x2 - x2_ref
-        add_data('dx-pix-2', dx2)
+            fit.load_stars_params(self.frame_path,
+                                  self._get_stars_params_group(camera))
+        return fit
 
-        # dy 1
-        if self.refresh:
-            dy1 = od.array(0., fit1[:,'y_err'][0])
-        else:
-            y1 = od.array(fit1[:,'y'][0], fit1[:,'y_err'][0])
-            y1_ref = od.array(fitR1[:,'y'][0], fitR1[:,'y_err'][0])
-            dy1 = y1 - y1_ref
-        add_data('dy-pix-1', dy1)
+    def _get_camera_stats(self, camera, fit):
+        """Return the stats computed from the stars fitted in one
+        camera (FWHM and shifts) as a dict.
+
+        :param camera: Camera number (1 or 2).
+
+        :param fit: Fitted stars parameters of the camera.
+        """
+        import orb.data as od
+
+        stats = dict()
+        if not self.refresh:
+            fitR = self._load_stars_params(camera, ref=True)
+
+        # dx, dy
+        for axis in ('x', 'y'):
+            if self.refresh:
+                shift = od.array(0., fit[:, axis + '_err'][0])
+            else:
+                pos = od.array(fit[:, axis][0], fit[:, axis + '_err'][0])
+                pos_ref = od.array(fitR[:, axis][0],
+                                   fitR[:, axis + '_err'][0])
+                shift = pos - pos_ref
+            _add_stat(stats, 'd{}-pix-{}'.format(axis, camera), shift)
+
+        # fwhm
+        _add_stat(stats, 'fwhm-pix-{}'.format(camera),
+                  od.array(fit[:, 'fwhm_pix'][0], fit[:, 'fwhm_err'][0]))
+        _add_stat(stats, 'fwhm-arc-{}'.format(camera),
+                  od.array(fit[:, 'fwhm_arc'][0],
+                           fit[:, 'fwhm_arc_err'][0]))
+
+        stats['odometer_nb'] = self.odometer_nb
+        return stats
+
+    def _get_merged_stats(self, fitM):
+        """Return the stats computed from the photometry of the
+        merged frame (flux, extinction and sky background) as a dict.
+
+        :param fitM: Stars parameters of the merged frame.
+        """
+        import orb.data as od
+
+        stats = dict()
+        fitRM = self._load_stars_params(0, ref=True)
 
-        # dx 2
-        if self.refresh:
-            dy2 = od.array(0., fit2[:,'y_err'][0])
-        else:
-            y2 = od.array(fit2[:,'y'][0], fit2[:,'y_err'][0])
-            y2_ref = od.array(fitR2[:,'y'][0], fitR2[:,'y_err'][0])
-            dy2 = y2 - y2_ref
-        add_data('dy-pix-2', dy2)      
-        
-        # fwhm 1
-        add_data('fwhm-pix-1', od.array(fit1[:, 'fwhm_pix'][0],
-                                        fit1[:, 'fwhm_err'][0]))
-        add_data('fwhm-arc-1', od.array(fit1[:, 'fwhm_arc'][0],
-                                        fit1[:, 'fwhm_arc_err'][0]))
-
-        add_data('fwhm-pix-2', od.array(fit2[:, 'fwhm_pix'][0],
-                                        fit2[:, 'fwhm_err'][0]))
-        add_data('fwhm-arc-2', od.array(fit2[:, 'fwhm_arc'][0],
-                                        fit2[:, 'fwhm_arc_err'][0]))
-        
-        
         # flux
         flux = od.nanmean(od.array(fitM[:, 'aperture_flux'],
                                    fitM[:, 'aperture_flux_err']))
-        add_data('flux', flux)
-
-        # extinction
-        fluxR = od.nanmean(od.array(fitRM[:, 'aperture_flux'],
-                                    fitRM[:, 'aperture_flux_err']))
-        add_data('extinction', -2.5 * od.log10(flux / fluxR))
+        _add_stat(stats, 'flux', flux)
+
+        # extinction: the reference flux is computed from the same
+        # stars as the flux, e.g. only the brightest stars are fitted
+        # in deadline mode
+        fitted = np.isfinite(np.array(fitM[:, 'aperture_flux'],
+                                      dtype=float))
+        fluxR_val = np.array(fitRM[:, 'aperture_flux'], dtype=float)
+        fluxR_err = np.array(fitRM[:, 'aperture_flux_err'], dtype=float)
+        if fluxR_val.size == fitted.size:
+            fluxR_val[~fitted] = np.nan
+            fluxR_err[~fitted] = np.nan
+        fluxR = od.nanmean(od.array(fluxR_val, fluxR_err))
+        _add_stat(stats, 'extinction', -2.5 * od.log10(flux / fluxR))
 
         # background
-        add_data('background', od.nanmean(
+        _add_stat(stats, 'background', od.nanmean(
             od.array(fitM[:, 'aperture_background'],
                      fitM[:, 'aperture_background_err'])))
 
+        stats['odometer_nb'] = self.odometer_nb
+        return stats
+
+    def get_stats(self):
+        """Return the computed stats in a nice human readable form as
+        a dict."""
+        stats = dict()
+        # stars are not fitted on a frame of bad quality
+        if not self.quality_flag:
+            stats.update(self._get_camera_stats(
+                1, self._load_stars_params(1)))
+            stats.update(self._get_camera_stats(
+                2, self._load_stars_params(2)))
+            stats.update(self._get_merged_stats(
+                self._load_stars_params(0)))
 
         stats['odometer_nb'] = self.odometer_nb
         stats['star_nb'] = self.star_nb
+        stats['fitted_star_nb'] = self.fitted_star_nb
+        stats['quality_flag'] = self.quality_flag
+        stats['peak-snr'] = self.peak_snr
+        stats['sky'] = self.sky
 
 
         # record stats as attributes
+        if self.refresh:
+            odometer_nb = None
+        else:
+            odometer_nb = self.odometer_nb
         for key in stats:
             self.reffile.add_attribute(
-                self._get_frame_group(), key, stats[key])
+                self._get_frame_group(), key, stats[key],
+                odometer_nb=odometer_nb)
         
         return stats
         
 
-class ReferenceFile(Tools):
-    """Manage the reference file"""
+class ReferenceFile(utils.ConfigCache, Tools):
+    """Manage the reference file.
 
-    def __init__(self, file_path, refresh=False, **kwargs):
+    The reference file is split into:
+
+    * the reference part (:file:`iris.ref`): alignment parameters,
+      reference star lists and the stars parameters of the reference
+      frame. It is only written when a reference image is analyzed.
+
+    * partitions (:file:`iris.ref.part{N}`): stars parameters and
+      stats of the other frames. Each partition records
+      :py:const:`iris.constants.REF_PARTITION_SIZE` consecutive
+      odometers so that the size of the file opened for each frame
+      stays small however long the night is.
+
+    * an index (:file:`iris.ref.index`): odometer and partition
+      number of each recorded frame (-1 for the reference frame).
+    """
+
+    def __init__(self, file_path, refresh=False,
+                 partition_size=constants.REF_PARTITION_SIZE, **kwargs):
         """Init class.
 
         :param file_path: Path to the reference file
@@ -374,6 +867,11 @@ class ReferenceFile(Tools):
         :param refresh: (Optional) If True, previous reference file is
           erased (default False).
 
+        :param partition_size: (Optional) Number of odometers recorded
+          in each partition. Only used when a new index is created,
+          else the partition size recorded in the index is used
+          (default :py:const:`iris.constants.REF_PARTITION_SIZE`).
+
         :param kwargs: kwargs of orb.core.Tools (see ORB
           documentation).
         """
@@ -381,10 +879,89 @@ class ReferenceFile(Tools):
         Tools.__init__(self, **kwargs)
 
         self.file_path = file_path
+        self.index_path = file_path + '.index'
 
         if refresh:
-            if os.path.exists(self.file_path):
-                os.remove(self.file_path)
+            for path in [self.file_path, self.index_path] + glob.glob(
+                self.file_path + '.part*'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if os.path.exists(self.index_path):
+            with self.open_hdf5(self.index_path, 'r') as f:
+                partition_size = f['index'].attrs['partition_size']
+        self.partition_size = int(partition_size)
+
+    def _get_path(self, odometer_nb):
+        """Return the path to the file where the data of a frame is
+        recorded.
+
+        :param odometer_nb: Odometer of the frame. If None, the path
+          to the reference part is returned.
+        """
+        if odometer_nb is None:
+            return self.file_path
+        return self.get_partition_path(
+            int(odometer_nb) // self.partition_size)
+
+    def get_partition_path(self, ipart):
+        """Return the path to a partition.
+
+        :param ipart: Partition number. If -1, the path to the
+          reference part is returned.
+        """
+        if ipart < 0:
+            return self.file_path
+        return self.file_path + '.part{:06d}'.format(ipart)
+
+    def register(self, odometer_nb, ref=False):
+        """Record a frame in the index and return the path to the file
+        where its data must be written.
+
+        :param odometer_nb: Odometer of the frame.
+
+        :param ref: (Optional) If True, the frame is the reference
+          frame and its data is recorded in the reference part
+          (default False).
+        """
+        if ref:
+            ipart = -1
+        else:
+            ipart = int(odometer_nb) // self.partition_size
+        with self.open_hdf5(self.index_path, 'a') as f:
+            if 'index' not in f:
+                f.create_dataset('index', shape=(0, 2), maxshape=(None, 2),
+                                 chunks=(256, 2), dtype=np.int64)
+                f['index'].attrs['partition_size'] = self.partition_size
+            index = f['index']
+            if not np.any(index[:,0] == odometer_nb):
+                index.resize((index.shape[0] + 1, 2))
+                index[-1,:] = (odometer_nb, ipart)
+        return self.get_partition_path(ipart)
+
+    def get_index(self):
+        """Return the index as an array of shape (frame_nb, 2) with
+        the odometer and the partition number of each recorded
+        frame. None is returned if no frame has been recorded.
+        """
+        if not os.path.exists(self.index_path):
+            return None
+        with self.open_hdf5(self.index_path, 'r') as f:
+            return f['index'][:]
+
+    def get_frame_path(self, odometer_nb):
+        """Return the path to the file where the data of a recorded
+        frame is written or None if the frame is not in the index.
+
+        :param odometer_nb: Odometer of the frame.
+        """
+        index = self.get_index()
+        if index is None:
+            return None
+        irow = np.nonzero(index[:,0] == odometer_nb)[0]
+        if irow.size == 0:
+            return None
+        return self.get_partition_path(index[irow[-1], 1])
 
     def append(self, dataset, arr):
         """Append a new dataset to the reference file.
@@ -397,22 +974,32 @@ class ReferenceFile(Tools):
                 del f[dataset]
             f[dataset] = np.array(arr)
 
-    def add_attribute(self, dataset, attr, value):
+    def add_attribute(self, dataset, attr, value, odometer_nb=None):
         """Add an attibute to a dataset
 
         :param dataset: Dataset path
         :param attr: Attribute name
         :param value: Value of the attribute.
+
+        :param odometer_nb: (Optional) If given, the dataset is
+          searched in the partition of this odometer instead of the
+          reference part (default None).
         """
-        with self.open_hdf5(self.file_path, 'a') as f:
+        with self.open_hdf5(self._get_path(odometer_nb), 'a') as f:
+            if dataset not in f:
+                f.create_group(dataset)
             f[dataset].attrs[attr] = value
 
-    def get_attributes(self, dataset):
+    def get_attributes(self, dataset, odometer_nb=None):
         """Return all the attributes of a dataset as a list of tuples.
 
         :param dataset: Dataset path.
+
+        :param odometer_nb: (Optional) If given, the dataset is
+          searched in the partition of this odometer instead of the
+          reference part (default None).
         """
-        with self.open_hdf5(self.file_path, 'r') as f:
+        with self.open_hdf5(self._get_path(odometer_nb), 'r') as f:
             attrs = list()
             for attr in f[dataset].attrs:
                 attrs.append((attr, f[dataset].attrs[attr]))
@@ -438,3 +1025,304 @@ class ReferenceFile(Tools):
              else:
                  self._print_error('{} not in reference file'.format(dataset))
 
+
+class SolutionCache(utils.ConfigCache, Tools):
+    """Cache of the reference solutions (alignment parameters,
+    reference star lists and FWHM) keyed by pointing.
+
+    Each solution is a group of the cache file with the pointing
+    (RA, DEC, filter, binning) and the number of reference stars as
+    attributes. A solution is found for a new reference image if it
+    has the same filter, binning and number of reference stars and if
+    its pointing is less than
+    :py:const:`iris.constants.REF_CACHE_RADIUS` away. The cache is not
+    erased when a new reference image is analyzed.
+    """
+
+    def __init__(self, file_path, radius=constants.REF_CACHE_RADIUS,
+                 **kwargs):
+        """Init class.
+
+        :param file_path: Path to the cache file.
+
+        :param radius: (Optional) Maximum distance (in arcseconds)
+          between two pointings (default
+          :py:const:`iris.constants.REF_CACHE_RADIUS`).
+
+        :param kwargs: kwargs of orb.core.Tools (see ORB
+          documentation).
+        """
+        Tools.__init__(self, **kwargs)
+
+        self.file_path = file_path
+        self.radius = float(radius)
+
+    def _find(self, f, pointing, ref_star_nb):
+        """Return the name of the nearest matching solution or None.
+
+        :param f: Opened cache file.
+
+        :param pointing: Tuple (RA, DEC, filter, binning). RA and DEC
+          are in degrees.
+
+        :param ref_star_nb: Maximum number of reference stars (None
+          if all the stars are kept).
+        """
+        ra, dec, filter_name, binning = pointing
+        if ref_star_nb is None: ref_star_nb = 0 # all the stars
+        best = None
+        best_dist = self.radius
+        for name in f:
+            attrs = f[name].attrs
+            if (attrs['filter'] != filter_name
+                or attrs['binning'] != binning
+                or attrs['ref_star_nb'] != ref_star_nb):
+                continue
+            dist = 3600. * math.hypot(
+                (attrs['ra'] - ra) * math.cos(math.radians(dec)),
+                attrs['dec'] - dec)
+            if dist <= best_dist:
+                best = name
+                best_dist = dist
+        return best
+
+    def get(self, pointing, ref_star_nb):
+        """Return the solution of a pointing as a dict of arrays or
+        None if no solution is found.
+
+        :param pointing: Tuple (RA, DEC, filter, binning). RA and DEC
+          are in degrees.
+
+        :param ref_star_nb: Maximum number of reference stars (None
+          if all the stars are kept).
+        """
+        if not os.path.exists(self.file_path):
+            return None
+        with self.open_hdf5(self.file_path, 'r') as f:
+            name = self._find(f, pointing, ref_star_nb)
+            if name is None:
+                return None
+            solution = dict()
+            for key in f[name]:
+                solution[key] = f[name][key][()]
+            return solution
+
+    def add(self, pointing, ref_star_nb, solution):
+        """Add the solution of a pointing. The solution previously
+        found for this pointing is replaced.
+
+        :param pointing: Tuple (RA, DEC, filter, binning). RA and DEC
+          are in degrees.
+
+        :param ref_star_nb: Maximum number of reference stars (None
+          if all the stars are kept).
+
+        :param solution: Dict of arrays.
+        """
+        with self.open_hdf5(self.file_path, 'a') as f:
+            name = self._find(f, pointing, ref_star_nb)
+            if name is not None:
+                del f[name]
+            else:
+                count = int(f.attrs.get('count', 0))
+                name = 'solution{}'.format(count)
+                f.attrs['count'] = count + 1
+            group = f.create_group(name)
+            for key in solution:
+                group[key] = np.array(solution[key])
+            ra, dec, filter_name, binning = pointing
+            group.attrs['ra'] = ra
+            group.attrs['dec'] = dec
+            group.attrs['filter'] = filter_name
+            group.attrs['binning'] = binning
+            # 0 if all the stars are kept
+            group.attrs['ref_star_nb'] = (
+                ref_star_nb if ref_star_nb is not None else 0)
+
+
+class StatsFile(utils.ConfigCache, Tools):
+    """Manage the stats file.
+
+    The stats of each frame are recorded as a row of a single
+    resizable table (one column per key of
+    :py:const:`iris.constants.STATS_KEYS`). The row index is the
+    frame index in the output cubes. A file written with other
+    columns (e.g. by an older version of IRIS) is read with the
+    current columns and rewritten at the next write.
+
+    The file is written in Single-Writer/Multiple-Reader (SWMR) mode
+    so that the viewer can read it while **iris** appends new rows.
+    The reader keeps the file open only while it reads it, so that
+    the writer, which opens the file once per frame, is always
+    opened first.
+
+    .. note:: The file is opened without HDF5 file locking (HDF5 >=
+       1.10) so that a reader never prevents **iris** from writing
+       it. With h5py >= 3.5 it is disabled for this file only. With an
+       older h5py (e.g. with Python 2), locking can only be disabled
+       for the whole process by setting the environment variable
+       HDF5_USE_FILE_LOCKING to FALSE before h5py is imported, which
+       **iris** and **iris-viewer** do.
+    """
+
+    _inode = None # inode of the file read by the last read
+    reopened = False # True if the file has been replaced before the last read
+
+    def __init__(self, file_path, refresh=False, **kwargs):
+        """Init class.
+
+        :param file_path: Path to the stats file
+
+        :param refresh: (Optional) If True, previous stats file is
+          erased (default False).
+
+        :param kwargs: kwargs of orb.core.Tools (see ORB
+          documentation).
+        """
+        Tools.__init__(self, **kwargs)
+
+        self.file_path = file_path
+
+        if refresh:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+
+    def _open(self, mode, **kwargs):
+        """Open the stats file and return the h5py.File instance.
+
+        HDF5 file locking is disabled for the file with h5py >= 3.5.
+        With an older h5py it must be disabled for the whole process
+        by setting the environment variable HDF5_USE_FILE_LOCKING to
+        FALSE before h5py is imported, as **iris** and
+        **iris-viewer** do.
+
+        :param mode: Opening mode.
+
+        :param kwargs: Keyword arguments of h5py.File.
+        """
+        if _H5PY_LOCKING:
+            kwargs['locking'] = False
+        try:
+            return h5py.File(self.file_path, mode, libver='latest',
+                             **kwargs)
+        except IOError, e:
+            if not _H5PY_LOCKING and 'lock' in str(e):
+                self._print_error('Stats file {} is locked by another process ({}). Use h5py >= 3.5 or set the environment variable HDF5_USE_FILE_LOCKING to FALSE.'.format(self.file_path, e))
+            raise
+
+    def _create(self, data):
+        """Create the stats file with the columns of
+        :py:const:`iris.constants.STATS_KEYS`. The file is written
+        under a temporary name and then renamed so that it is never
+        read incomplete.
+
+        :param data: Rows of the table, array of shape (frame_nb,
+          len(:py:const:`iris.constants.STATS_KEYS`)).
+        """
+        tmp_path = self.file_path + '.tmp'
+        with h5py.File(tmp_path, 'w', libver='latest') as f:
+            f.create_dataset(
+                'stats', data=data, maxshape=(None, data.shape[1]),
+                chunks=(64, data.shape[1]), dtype=float, fillvalue=np.nan)
+            f['stats'].attrs['keys'] = np.array(constants.STATS_KEYS,
+                                                dtype='S')
+        os.rename(tmp_path, self.file_path)
+
+    def _reorder(self, data, keys):
+        """Return rows recorded with other columns (e.g. by an older
+        version of IRIS) with the columns of
+        :py:const:`iris.constants.STATS_KEYS`. Missing columns are
+        set to NaN.
+
+        :param data: Rows of the table.
+
+        :param keys: Keys of the columns of the rows.
+        """
+        rows = np.empty((data.shape[0], len(constants.STATS_KEYS)),
+                        dtype=float)
+        rows.fill(np.nan)
+        for ikey in range(len(constants.STATS_KEYS)):
+            key = constants.STATS_KEYS[ikey]
+            if key in keys and keys.index(key) < data.shape[1]:
+                rows[:,ikey] = data[:,keys.index(key)]
+        return rows
+
+    def write(self, index, stats):
+        """Write the stats of a frame.
+
+        :param index: Index of the frame.
+
+        :param stats: Dict of stats. Keys which are not in
+          :py:const:`iris.constants.STATS_KEYS` are ignored and
+          missing keys are set to NaN.
+        """
+        row = np.empty(len(constants.STATS_KEYS), dtype=float)
+        row.fill(np.nan)
+        for ikey in range(len(constants.STATS_KEYS)):
+            if constants.STATS_KEYS[ikey] in stats:
+                row[ikey] = stats[constants.STATS_KEYS[ikey]]
+
+        # new objects cannot be created in SWMR mode
+        if not os.path.exists(self.file_path):
+            self._create(np.empty((0, row.size), dtype=float))
+        else:
+            with self._open('r') as f:
+                keys = _get_stats_keys(f['stats'])
+                if keys != constants.STATS_KEYS:
+                    data = f['stats'][:]
+            if keys != constants.STATS_KEYS:
+                self._print_warning('Stats file {} written with other columns (e.g. by an older version of IRIS): rewritten with the current columns'.format(self.file_path))
+                self._create(self._reorder(data, keys))
+                
+        with self._open('r+') as f:
+            f.swmr_mode = True
+            dset = f['stats']
+            if index >= dset.shape[0]:
+                dset.resize((index + 1, row.size))
+            dset[index,:] = row
+            dset.flush()
+
+    def read(self, start=0):
+        """Return the stats of the frames as an array of shape
+        (frame_nb - start, len(:py:const:`iris.constants.STATS_KEYS`)).
+
+        The file is opened in SWMR read mode and closed after each
+        call. If it has been replaced since the last call (e.g. after
+        a new reference image), :py:attr:`StatsFile.reopened` is set
+        to True and the previously read rows must be discarded. None
+        is returned if the file does not exist yet.
+
+        :param start: (Optional) Index of the first frame to read
+          (default 0).
+        """
+        self.reopened = False
+        if not os.path.exists(self.file_path):
+            self._inode = None
+            return None
+
+        inode = os.stat(self.file_path).st_ino
+        # the file cannot be opened while the writer is creating it or
+        # switching to SWMR mode
+        for i in range(constants.STATS_READ_ATTEMPTS):
+            try:
+                f = self._open('r', swmr=True)
+                break
+            except IOError:
+                if i == constants.STATS_READ_ATTEMPTS - 1:
+                    raise
+                time.sleep(constants.STATS_READ_DELAY)
+        with f:
+            if 'stats' not in f:
+                return None
+            stats = f['stats'][start:]
+            keys = _get_stats_keys(f['stats'])
+        if keys != constants.STATS_KEYS:
+            stats = self._reorder(stats, keys)
+        self.reopened = (inode != self._inode)
+        self._inode = inode
+        return stats
+
+    def close(self):
+        """Forget the file read by :py:meth:`StatsFile.read`. The next
+        read is considered as a reopening."""
+        self._inode = None
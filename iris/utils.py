@@ -21,9 +21,94 @@
 ## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
 
 import socket
+import threading
+import collections
+import os
+
+import constants
+
+SitelleConfig = collections.namedtuple(
+    'SitelleConfig', [key.lower() for key in constants.CONFIG_KEYS])
+"""Read-only SITELLE configuration (see
+:py:const:`iris.constants.CONFIG_KEYS`)"""
+
+_config_cache = dict() # configuration parameters by (file name, key)
+_sitelle_configs = dict() # SitelleConfig instances by file name
+_config_cache_classes = dict() # classes returned by with_config_cache
+
+class ConfigCache(object):
+    """Mixin caching the configuration parameters read by
+    orb.core.Tools. Each parameter of a configuration file is read
+    only once per process and shared by all the instances, whatever
+    their class.
+
+    It must be placed before orb.core.Tools in the base classes,
+    e.g.::
+
+      class ImageStats(utils.ConfigCache, Tools):
+
+    ORB classes can be given the cache with
+    :py:func:`iris.utils.with_config_cache`.
+    """
+
+    def _get_config_parameter(self, param_key, optional=False):
+        """Return a parameter of the configuration file (see
+        orb.core.Tools._get_config_parameter). The parameter is read
+        from the file only at the first call.
+
+        :param param_key: Key of the parameter.
+
+        :param optional: (Optional) If True, None is returned if the
+          parameter is not found instead of raising an error (default
+          False).
+        """
+        key = (self.config_file_name, param_key)
+        if key not in _config_cache:
+            value = super(ConfigCache, self)._get_config_parameter(
+                param_key, optional=optional)
+            # a missing optional parameter is not cached
+            if value is None:
+                return None
+            _config_cache[key] = value
+        return _config_cache[key]
+
+
+def with_config_cache(cls):
+    """Return a subclass of an orb.core.Tools class (e.g.
+    orb.astrometry.Astrometry) whose configuration parameters are
+    cached (see :py:class:`iris.utils.ConfigCache`). The subclass is
+    created only once per class.
+
+    :param cls: orb.core.Tools subclass.
+    """
+    if cls not in _config_cache_classes:
+        _config_cache_classes[cls] = type(cls.__name__, (ConfigCache, cls),
+                                          dict())
+    return _config_cache_classes[cls]
+
+
+def get_sitelle_config(tools):
+    """Return the SITELLE configuration parameters used by IRIS as a
+    :py:class:`iris.utils.SitelleConfig` instance.
+
+    The configuration file is parsed only once per process. The same
+    instance is then returned by all the following calls made with
+    the same configuration file.
+
+    :param tools: orb.core.Tools instance initialized with the
+      SITELLE configuration file (see
+      :py:const:`iris.constants.CONFIG_FILE_NAME`).
+    """
+    if tools.config_file_name not in _sitelle_configs:
+        _sitelle_configs[tools.config_file_name] = SitelleConfig(*[
+            float(tools._get_config_parameter(key))
+            for key in constants.CONFIG_KEYS])
+    return _sitelle_configs[tools.config_file_name]
+
 
 def send_msg_to_daemon(msg, port):
     """Send a message to the listener daemon created by iris-viewer.
+    Return True if the message has been sent.
     
     :param msg: Message to send
     :param port: Listening port
@@ -34,6 +119,113 @@ def send_msg_to_daemon(msg, port):
         s.connect((socket.gethostname(), port))
         s.send(msg.encode('ascii'))
         s.close()
+        return True
     except Exception, e:
         print 'Error on sending {} to listener daemon on port {}: {}'.format(
             msg, port, e)
+        return False
+
+
+def is_daemon_listening(port):
+    """Return True if a listener daemon (e.g. created by iris-viewer)
+    accepts connections on a given port. No message is sent.
+
+    :param port: Listening port
+    """
+    try:
+        s = socket.socket(socket.AF_INET,
+                          socket.SOCK_STREAM)
+        s.connect((socket.gethostname(), port))
+        s.close()
+        return True
+    except Exception:
+        return False
+
+
+class ListenerDaemon(threading.Thread):
+    """Socket listener thread receiving the messages sent with
+    :py:func:`iris.utils.send_msg_to_daemon`.
+
+    Messages are handled one at a time in the order they are
+    received. The listener stops when the message 'stop' is
+    received.
+    """
+
+    def __init__(self, port, callback):
+        """Init class. The socket is bound immediatly, the thread
+        must then be started with :py:meth:`threading.Thread.start`.
+
+        :param port: Listening port.
+
+        :param callback: Function called with each received message
+          (except 'stop'). Exceptions raised by the callback are
+          printed and the listener goes on.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.callback = callback
+        self.msg_nb = 0 # number of received messages
+        self.error_nb = 0 # number of messages whose handling failed
+        self.socket = socket.socket(socket.AF_INET,
+                                    socket.SOCK_STREAM)
+        # the port can be reused immediatly after a restart
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((socket.gethostname(), self.port))
+        self.socket.listen(5)
+
+    def run(self):
+        stop = False
+        while not stop:
+            # establish connection with client socket
+            clientSocket, addr = self.socket.accept()
+            msg = clientSocket.recv(1024).decode('ascii')
+            clientSocket.close()
+            # empty connections only check that the daemon listens
+            # (see iris.utils.is_daemon_listening)
+            if not msg: continue
+            self.msg_nb += 1
+            print ' > message from {}: {}'.format(addr, msg)
+            if msg == 'stop':
+                stop = True
+            else:
+                try:
+                    self.callback(msg)
+                except Exception, e:
+                    self.error_nb += 1
+                    print ' > Error: {}'.format(e)
+        self.socket.close()
+        print ' > daemon listener stopped'
+
+
+def bin_image(im, binning):
+    """Return an image binned by averaging blocks of binning x binning
+    pixels. NaNs are ignored. The pixels on the borders which do not
+    fill a complete block are dropped. The binned image has the same
+    data type as the image but the sums are computed in float64.
+
+    :param im: Image to bin.
+    :param binning: Binning factor.
+    """
+    import numpy as np
+
+    dimx = (im.shape[0] // binning) * binning
+    dimy = (im.shape[1] // binning) * binning
+    blocks = im[:dimx, :dimy].reshape(
+        (dimx // binning, binning, dimy // binning, binning))
+    count = np.sum(~np.isnan(blocks), axis=(1,3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.nansum(blocks, axis=(1,3), dtype=np.float64)
+                / count).astype(im.dtype)
+
+
+def get_preview_path(cube_path, binning):
+    """Return the path to the preview cube of a given binning,
+    e.g. cube.1.hdf5 -> cube-bin4.1.hdf5.
+
+    :param cube_path: Path to the full resolution cube.
+    :param binning: Binning of the preview.
+    """
+    dirname, basename = os.path.split(cube_path)
+    root, ext = basename.split('.', 1)
+    return os.path.join(dirname, '{}-bin{}.{}'.format(root, binning, ext))
@@ -21,28 +21,175 @@
 ## along with IRIS.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from orb.viewer import BaseViewer, ZPlotWindow
-import socket
-import threading
+from orb.viewer import BaseViewer
 import gtk
+import gobject
 import os
-from orb.core import HDFCube
-from orb.astrometry import StarsParams
-from stats import ReferenceFile
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg
+from live import ViewerData
+import constants
+import utils
+
+
+def decimate_minmax(zdata, bin_size):
+    """Decimate a vector by min/max binning. Return the min and the
+    max of each complete bin (NaNs are ignored). The last incomplete
+    bin is dropped.
+
+    :param zdata: Vector to decimate.
+
+    :param bin_size: Number of points in each bin.
+    """
+    bin_nb = zdata.size // bin_size
+    bins = zdata[:bin_nb * bin_size].reshape((bin_nb, bin_size))
+    return np.fmin.reduce(bins, axis=1), np.fmax.reduce(bins, axis=1)
+
+
+class StatsPlotWindow(object):
+    """Window plotting the evolution of one or more stats with the
+    frame index (one subplot per stat).
+
+    Plots are updated incrementally: only the points added since the
+    last update are processed. Long series are decimated by min/max
+    binning so that each curve never has more than about
+    2 * :py:attr:`StatsPlotWindow.max_bin_nb` points.
+    """
+
+    max_bin_nb = 1000 # maximum number of displayed bins
+
+    def __init__(self, title='Stats'):
+        """Init class.
+
+        :param title: (Optional) Window title (default 'Stats').
+        """
+        self.w = gtk.Window()
+        self.w.set_title(title)
+        self.w.set_default_size(600, 400)
+        self.fig = Figure()
+        self.canvas = FigureCanvasGTKAgg(self.fig)
+        self.w.add(self.canvas)
+        self.keys = list()
+        self._lines = dict()
+        self._clear_bins()
+
+    def _clear_bins(self):
+        """Clear the decimated data."""
+        self.bin_size = 1
+        self._done = 0 # number of points in complete bins
+        self._mins = dict()
+        self._maxs = dict()
+        for key in self.keys:
+            self._mins[key] = np.empty(0, dtype=float)
+            self._maxs[key] = np.empty(0, dtype=float)
+
+    def show(self):
+        """Show the window."""
+        self.w.show_all()
+
+    def is_visible(self):
+        """Return True if the window is visible."""
+        return self.w.get_property('visible')
+
+    def set_keys(self, keys):
+        """Set the stats to plot.
+
+        :param keys: List of keys of
+          :py:const:`iris.constants.STATS_KEYS`.
+        """
+        keys = list(keys)
+        if keys == self.keys: return
+        self.keys = keys
+        self.fig.clf()
+        self._lines = dict()
+        ax0 = None
+        for ikey in range(len(self.keys)):
+            ax = self.fig.add_subplot(len(self.keys), 1, ikey + 1,
+                                      sharex=ax0)
+            if ax0 is None: ax0 = ax
+            ax.set_ylabel(self.keys[ikey])
+            self._lines[self.keys[ikey]] = ax.plot([], [], c='0.')[0]
+        self._clear_bins()
+
+    def update(self, store):
+        """Append the new points of a stats store to the plots.
+
+        :param store: :py:class:`iris.live.StatsStore` instance.
+        """
+        n = store.frame_nb
+        if n < self._done:
+            self._clear_bins()
+        
+        # the last complete bin is computed again since its last
+        # point may have been updated
+        start = max(self._done - self.bin_size, 0)
+        done = (n // self.bin_size) * self.bin_size
+        for key in self.keys:
+            mins, maxs = decimate_minmax(store[key][start:done],
+                                         self.bin_size)
+            self._mins[key] = np.concatenate((
+                self._mins[key][:start // self.bin_size], mins))
+            self._maxs[key] = np.concatenate((
+                self._maxs[key][:start // self.bin_size], maxs))
+        self._done = done
+
+        # merge pairs of bins when there are too many bins
+        while done // self.bin_size > self.max_bin_nb:
+            bin_nb = (done // self.bin_size) // 2 * 2
+            for key in self.keys:
+                mins = self._mins[key][:bin_nb]
+                maxs = self._maxs[key][:bin_nb]
+                self._mins[key] = np.fmin(mins[0::2], mins[1::2])
+                self._maxs[key] = np.fmax(maxs[0::2], maxs[1::2])
+            self.bin_size *= 2
+            self._done = done = bin_nb // 2 * self.bin_size
+
+        # bins are drawn as vertical segments at their center
+        # followed by the remaining points
+        xbins = (np.arange(self._done // self.bin_size, dtype=float)
+                 * self.bin_size + (self.bin_size - 1) / 2.)
+        xtail = np.arange(self._done, n, dtype=float)
+        for key in self.keys:
+            ybins = np.empty(2 * xbins.size, dtype=float)
+            ybins[0::2] = self._mins[key]
+            ybins[1::2] = self._maxs[key]
+            self._lines[key].set_data(
+                np.concatenate((np.repeat(xbins, 2), xtail)),
+                np.concatenate((ybins, store[key][self._done:n])))
+            ax = self._lines[key].axes
+            ax.relim()
+            ax.autoscale_view()
+        self.canvas.draw_idle()
 
 
 class IrisViewer(BaseViewer):
-    """Iris Viewer class."""
+    """Iris Viewer class.
+
+    The data of the displayed cube (stats, preview cube and shared
+    frames) is reloaded by a :py:class:`iris.live.ViewerData`
+    instance which does not depend on the display.
+    """
 
     daemon = None # IRIS daemon instance
     daemon_port = None # Communication port of the daemon
     _lock = False
     
-    iris_reffile_path = None # reference file path
-    iris_all_stats = None # iris stats of all frames
+    data = None # ViewerData instance
+
+    stat_window = None # StatsPlotWindow instance
+
+    _scrub_index = None # last frame index set by the user
 
-    stat_window = None # stat window
+    def __init__(self, *args, **kwargs):
+        """Init class.
 
+        :param args: Arguments of orb.viewer.BaseViewer.
+
+        :param kwargs: Keyword arguments of orb.viewer.BaseViewer.
+        """
+        self.data = ViewerData()
+        BaseViewer.__init__(self, *args, **kwargs)
 
     def _toggle_lock_cb(self, c):
         self._lock = ~self._lock
@@ -83,7 +230,8 @@ class IrisViewer(BaseViewer):
 
         self.stats_store = gtk.ListStore(str, str, str)
         stats_tv = gtk.TreeView(self.stats_store)
-        stats_tv.connect('cursor-changed', self._get_selected_stat)
+        stats_tv.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
+        stats_tv.get_selection().connect('changed', self._get_selected_stat)
         key_render = gtk.CellRendererText()
         key_render.set_property('font', 'mono')
         key_render.set_property('size-points', 10)
@@ -131,34 +279,20 @@ class IrisViewer(BaseViewer):
               s.send('stop'.encode('ascii'))
               s.close()    
         """
-        def _listen():
-            stop = False
-            while not stop:
-                # establish connection with client socket
-                clientSocket, addr = s.accept()
-                msg = clientSocket.recv(1024).decode('ascii')
-                print ' > message from {}: {}'.format(addr, msg)
-                if 'update' in msg:
-                    path = msg.split()[1]
-                    print ' > filepath: ', path
-                    if os.path.abspath(path) == os.path.abspath(
-                        self.filepath):
-                        if not self._lock:
-                            self._reload_file()
-                    else:
-                        self.load_file(path)
-                elif msg == 'stop':
-                    stop = True
-                clientSocket.close()
-            print ' > daemon listener stopped'
+        def _handle(msg):
+            if 'update' in msg:
+                path = msg.split()[1]
+                print ' > filepath: ', path
+                if os.path.abspath(path) == os.path.abspath(
+                    self.filepath):
+                    if not self._lock:
+                        self._reload_file()
+                else:
+                    self.load_file(path)
 
         self.daemon_port = daemon_port
-        s = socket.socket(socket.AF_INET,
-                          socket.SOCK_STREAM)
-        s.bind((socket.gethostname(), self.daemon_port))
-        s.listen(5)
-        self.daemon = threading.Thread(target=_listen)
-        self.daemon.daemon = True
+        self.data.daemon_port = daemon_port
+        self.daemon = utils.ListenerDaemon(self.daemon_port, _handle)
         self.daemon.start()
 
     def _update_iris_cb(self, c):
@@ -166,41 +300,76 @@ class IrisViewer(BaseViewer):
 
         :param c: Caller instance.
         """
-        self.iris_all_stats = None
+        self.data.clear_stats()
         if not self._lock:
             self._reload_file()
 
     def _get_selected_stat(self, c):
         """stat-selection-callback.
 
-        :param c: Caller instance.
+        All the selected stats (use CTRL to select more than one) are
+        plotted in the same window.
+
+        :param c: Caller instance (gtk.TreeSelection).
         """
-        selection = c.get_selection()
-        selection.set_mode(gtk.SELECTION_SINGLE)
-        tree_model, tree_iter = selection.get_selected()
-        selected_stat = tree_model.get_value(tree_iter, 0)
-        self.update_all_stats()
-        zdata = self.iris_all_stats[0,:,selected_stat]
-        if self.stat_window is None:
-            self.stat_window = ZPlotWindow(None, None, None, None,
-                                           title='Stats', simple=True)
-            self.stat_window.show()
-        elif not self.stat_window.w.get_property('visible'):
-            self.stat_window = ZPlotWindow(None, None, None, None,
-                                           title='Stats', simple=True)
+        tree_model, paths = c.get_selected_rows()
+        selected_stats = [tree_model[path][0] for path in paths]
+        if len(selected_stats) == 0: return
+        if self.data.all_stats is None: return
+        if self.stat_window is None or not self.stat_window.is_visible():
+            self.stat_window = StatsPlotWindow(title='Stats')
             self.stat_window.show()
             
-        self.stat_window.update(zdata, ylabel=selected_stat)
+        self.stat_window.set_keys(selected_stats)
+        self.stat_window.update(self.data.all_stats)
+
+    def _update_stat_window(self):
+        """Append the new stats to the stat window if it is opened."""
+        if self.stat_window is None: return
+        if self.data.all_stats is None: return
+        if self.stat_window.is_visible():
+            self.stat_window.update(self.data.all_stats)
 
     def _set_image_index_cb(self, c):
         """set-image-index-callback.
 
         Called when a new image index is choosen.
 
+        While the user scrubs through the cube the preview of the
+        frame is displayed. The full resolution frame is loaded only
+        when the index has not changed for
+        :py:const:`iris.constants.PREVIEW_DELAY` ms.
+
         :param c: Caller instance.
         """
-        self.update_stats_store(int(c.get_value()))
-        BaseViewer._set_image_index_cb(self, c)
+        index = int(c.get_value())
+        self.update_stats_store(index)
+        preview_cube = self.data.get_preview_cube()
+        if preview_cube is None or index >= preview_cube.dimz:
+            BaseViewer._set_image_index_cb(self, c)
+            return
+        
+        self._scrub_index = index
+        cube = self.cube
+        self.cube = preview_cube
+        try:
+            BaseViewer._set_image_index_cb(self, c)
+        finally:
+            self.cube = cube
+        gobject.timeout_add(constants.PREVIEW_DELAY,
+                            self._load_full_frame_cb, c, index)
+
+    def _load_full_frame_cb(self, c, index):
+        """Load the full resolution frame if the frame index has not
+        changed since it was set.
+
+        :param c: Caller instance.
+
+        :param index: Frame index set by the user.
+        """
+        if index == self._scrub_index:
+            BaseViewer._set_image_index_cb(self, c)
+        return False # the timeout is not repeated
         
     def _camera_changed_cb(self, c):
         """camera-changed-callback.
@@ -228,54 +397,20 @@ class IrisViewer(BaseViewer):
     def _postload_call(self):
         """Function called immediatly after a cube as been loaded"""
         
+        self._scrub_index = None
+        self.cube = self.data.set_cube(self.filepath, self.cube)
         self.wimage_index.set_value(self.dimz - 1)
-        self.update_all_stats()
         self.update_stats_store(self.dimz - 1)
+        self._update_stat_window()
 
-    def update_all_stats(self):
-        """Load all the statistics of all the frames."""
-        
-        self.iris_reffile_path = os.path.join(
-            os.path.split(self.filepath)[0], 'iris.ref')
-        reffile = ReferenceFile(self.iris_reffile_path)
-        
-        iris_all_stats = StarsParams(1, self.cube.shape[2])
-        
-        cube = HDFCube(self.filepath)
-        for iframe in range(self.cube.dimz):
-            frame_stats = None
-            if self.iris_all_stats is not None:
-                if iframe < self.iris_all_stats.frame_nb:
-                    if self.iris_all_stats[0, iframe] != {}:
-                        frame_stats = self.iris_all_stats[0, iframe]
-                        
-            if frame_stats is None:
-                try:
-                    odometer_nb = cube.get_frame_attribute(
-                        iframe, 'odometer_nb')
-                    stats = reffile.get_attributes('{}'.format(odometer_nb))
-                    frame_stats = dict()
-                    for istat in stats:
-                        frame_stats[istat[0]] = istat[1]
-                except Exception, e:
-                    print 'Error: {}'.format(e)
-
-            if frame_stats is not None:
-                iris_all_stats[0, iframe] = frame_stats
-                
-        self.iris_all_stats = iris_all_stats
-                
-        del reffile
-                
-            
     def update_stats_store(self, index):
         """Update displayed statistics."""
         self.stats_store.clear()
-        if self.iris_all_stats is not None:
-            if self.iris_all_stats.frame_nb > index:
-                stats = self.iris_all_stats[:,index][0]
-                for istat in stats:
-                    if '_err' not in istat:
+        if self.data.all_stats is not None:
+            if self.data.all_stats.frame_nb > index:
+                stats = self.data.all_stats.get_frame(index)
+                for istat in constants.STATS_KEYS:
+                    if '_err' not in istat and istat in stats:
                         key = istat
                         if isinstance(stats[key], float):
                             val = '{:.2f}'.format(stats[key])